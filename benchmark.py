@@ -0,0 +1,240 @@
+"""Benchmarks all processing stages of testat2 against the simulated devices.
+
+Every stage is run for several input sizes. For each size the best time of
+a few repetitions, the throughput and the peak memory (measured in a
+separate run with tracemalloc) are reported. The results can be saved as a
+JSON baseline and compared with a baseline of an earlier commit:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from dateien.devices import SineSource, Oscilloscope, Filter, \
+    VoltageSource, Diode, VoltMeter, AmpereMeter
+from testat2 import vi_characteristic, is_strictly_monotonic, interpolation, \
+    iq_measurements, frequency_response, group_delay, save_data, load_data
+
+
+def bench_iq_measurements(n):
+    source = SineSource()
+    scope = Oscilloscope(source, Filter())
+    f = np.logspace(3, 6, 8)
+    scope.nsamples = n
+
+    def run():
+        iq_measurements(source, scope, f, 1.0)
+    return run, len(f) * n, "samples"
+
+
+def bench_frequency_response(n):
+    rng = np.random.default_rng(0)
+    i1, q1, i2, q2 = rng.normal(size=(4, n))
+
+    def run():
+        frequency_response(i1, q1, i2, q2, unwrap=True)
+    return run, n, "points"
+
+
+def bench_group_delay(n, method):
+    f = np.logspace(3, 6, n)
+    phi = -np.arctan(f * 2 * np.pi * 3300 * 1.5e-9)
+
+    def run():
+        group_delay(f, phi, method=method)
+    return run, n, "points"
+
+
+def bench_interpolation(n):
+    v = np.linspace(0, 1, 1000)
+    vi = np.c_[v, np.exp(3 * v)]
+    points = {"V": np.random.default_rng(0).uniform(0, 1, n),
+              "I": np.random.default_rng(1).uniform(1, 20, n)}
+
+    def run():
+        interpolation(vi, points)
+    return run, 2 * n, "points"
+
+
+def bench_is_strictly_monotonic(n):
+    v = np.linspace(0, 1, n)
+    vi = np.c_[v, np.exp(3 * v)]
+
+    def run():
+        is_strictly_monotonic(vi)
+    return run, n, "points"
+
+
+def bench_save_data(n, directory):
+    fname = os.path.join(directory, "save_data.txt")
+    data = np.random.default_rng(0).normal(size=(5, n))
+
+    def run():
+        save_data(fname, *data, labels=["f", "I1", "Q1", "I2", "Q2"])
+    return run, n, "rows"
+
+
+def bench_load_data(n, directory):
+    fname = os.path.join(directory, "load_data.txt")
+    save_data(fname, *np.random.default_rng(0).normal(size=(5, n)),
+              labels=["f", "I1", "Q1", "I2", "Q2"])
+
+    def run():
+        load_data(fname, col_labels=True)
+    return run, n, "rows"
+
+
+def bench_vi_characteristic(n, batch):
+    source = VoltageSource()
+    source_voltage = np.linspace(0, 5, n)
+
+    def run():
+        # a new diode every run, so the operating point cache starts empty
+        diode = Diode(source)
+        vi_characteristic(source, VoltMeter(diode), AmpereMeter(diode),
+                          source_voltage, batch=batch)
+    return run, n, "points"
+
+
+def stages(quick, directory):
+    """Returns the name, size and factory of all benchmarks."""
+    scale = 1 if quick else 10
+    return [
+        ("iq_measurements", [1000 * scale, 10000 * scale],
+         bench_iq_measurements),
+        ("frequency_response", [1000, 10000 * scale, 100000 * scale],
+         bench_frequency_response),
+        ("group_delay gradient", [1000, 10000 * scale],
+         lambda n: bench_group_delay(n, "gradient")),
+        ("group_delay spline", [1000, 10000 * scale],
+         lambda n: bench_group_delay(n, "spline")),
+        ("interpolation", [1000, 10000 * scale, 100000 * scale],
+         bench_interpolation),
+        ("is_strictly_monotonic", [1000, 10000 * scale, 100000 * scale],
+         bench_is_strictly_monotonic),
+        ("save_data", [1000, 10000 * scale],
+         lambda n: bench_save_data(n, directory)),
+        ("load_data", [1000, 10000 * scale],
+         lambda n: bench_load_data(n, directory)),
+        ("vi_characteristic", [26, 100 * scale],
+         lambda n: bench_vi_characteristic(n, False)),
+        ("vi_characteristic batch", [1000, 10000 * scale],
+         lambda n: bench_vi_characteristic(n, True)),
+    ]
+
+
+def measure(run, repeat):
+    """Returns the best time of repeat runs and the peak memory of one run."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, peak
+
+
+def git_commit():
+    try:
+        # the commit of the benchmarked code, not of the working directory
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(quick=False, repeat=3, only=None):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, sizes, factory in stages(quick, directory):
+            if only and not any(part in name for part in only):
+                continue
+            for size in sizes:
+                run, items, unit = factory(size)
+                seconds, peak = measure(run, repeat)
+                results.append({"stage": name,
+                                "size": size,
+                                "unit": unit,
+                                "seconds": seconds,
+                                "throughput": items / seconds,
+                                "peak_bytes": peak})
+                print(f"{name:25s} {size:>8d} {unit:8s} "
+                      f"{seconds * 1e3:10.3f} ms "
+                      f"{items / seconds:12.4g} {unit}/s "
+                      f"{peak / 2 ** 20:8.2f} MiB")
+    return {"meta": {"commit": git_commit(),
+                     "python": platform.python_version(),
+                     "numpy": np.__version__,
+                     "scipy": scipy.__version__,
+                     "machine": platform.machine(),
+                     "quick": quick},
+            "results": results}
+
+
+def compare(report, baseline, threshold):
+    """Prints the change of every stage against the baseline and returns
+    the number of stages which got slower than the threshold."""
+    old = {(result["stage"], result["size"]): result
+           for result in baseline["results"]}
+    regressions = 0
+    print(f"\ncompared with {baseline['meta'].get('commit')}:")
+    for result in report["results"]:
+        key = (result["stage"], result["size"])
+        if key not in old:
+            continue
+        ratio = result["seconds"] / old[key]["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{result['stage']:25s} {result['size']:>8d} "
+              f"{ratio:8.2f}x time{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true",
+                        help="only use small input sizes")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="repetitions per size, the best one is kept")
+    parser.add_argument("--only", nargs="*",
+                        help="only run stages containing one of these names")
+    parser.add_argument("--output", help="save the results as JSON baseline")
+    parser.add_argument("--baseline", help="JSON baseline to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown reported as regression")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.quick, args.repeat, args.only)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold) > 0:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
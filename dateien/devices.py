@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+from collections import OrderedDict
+
 import numpy as np
 from scipy.optimize import brentq
 
@@ -31,11 +34,16 @@ class VoltageSource(Device):
 
 
 class Diode:
-    def __init__(self, source):
+    def __init__(self, source, cache_size=1024):
         if not isinstance(source, VoltageSource):
             raise TypeError('the source is not a voltage source')
         self._input = source
         self._R = 23.0
+        # operating points already solved, keyed by the source voltage and
+        # ordered from the least to the most recently used one
+        self._operating_points = OrderedDict()
+        self._cache_size = int(cache_size)
+        self._last_batch = None
 
     def _i_diode(self, v):
         return 1e-3*(np.exp(v*3) - 1)
@@ -46,10 +54,62 @@ class Diode:
 
     @property
     def _output_voltage(self):
+        voltage = self._input.voltage
+        if voltage in self._operating_points:
+            self._operating_points.move_to_end(voltage)
+            return self._operating_points[voltage]
+
+        v = self._solve(voltage)
+        if self._cache_size > 0:
+            self._operating_points[voltage] = v
+            if len(self._operating_points) > self._cache_size:
+                self._operating_points.popitem(last=False)
+        return v
+
+    def _solve(self, voltage):
         return brentq(lambda v: self._i_diode(v)
-                      - (self._input.voltage - v)/self._R,
+                      - (voltage - v)/self._R,
                       0,
-                      self._input.voltage)
+                      voltage)
+
+    def _solve_batch(self, voltages):
+        # newton iteration on all operating points at once, a step leaving
+        # the bracket [min(0, V), max(0, V)] is replaced by a bisection
+        voltages = np.asarray(voltages, dtype=float)
+        low = np.minimum(voltages, 0.0)
+        high = np.maximum(voltages, 0.0)
+        v = (low + high)/2
+        for _ in range(100):
+            g = self._i_diode(v) - (voltages - v)/self._R
+            high = np.where(g > 0, v, high)
+            low = np.where(g > 0, low, v)
+            dg = 3e-3*np.exp(v*3) + 1/self._R
+            step = v - g/dg
+            step = np.where((step <= low) | (step >= high),
+                            (low + high)/2, step)
+            converged = np.all(np.abs(step - v) <= 2e-12 + 4e-16*np.abs(v))
+            v = step
+            if converged:
+                break
+        return v
+
+    def _output_voltages(self, voltages):
+        voltages = np.array(voltages, dtype=float)
+        # the volt and ampere meter usually ask for the same sweep
+        if self._last_batch is not None \
+                and np.array_equal(self._last_batch[0], voltages):
+            return self._last_batch[1].copy()
+        v = self._solve_batch(voltages)
+        self._last_batch = (voltages, v)
+        # the caller gets a copy, so it can't change the cached sweep
+        return v.copy()
+
+    def _input_currents(self, voltages):
+        return self._i_diode(self._output_voltages(voltages))
+
+    def _clear_cache(self):
+        self._operating_points.clear()
+        self._last_batch = None
 
 
 class AmpereMeter(Device):
@@ -62,6 +122,9 @@ class AmpereMeter(Device):
     def measure(self):
         return self._load._input_current
 
+    def measure_sweep(self, voltages):
+        return self._load._input_currents(voltages)
+
 
 class VoltMeter(Device):
     def __init__(self, load):
@@ -73,6 +136,9 @@ class VoltMeter(Device):
     def measure(self):
         return self._load._output_voltage
 
+    def measure_sweep(self, voltages):
+        return self._load._output_voltages(voltages)
+
 
 # create all devices for the first measurement setup
 voltage_source = VoltageSource()
@@ -87,6 +153,8 @@ class SineSource(Device):
         super().__init__(description='Sine Source')
         self._amplitude = 0.0
         self._frequency = 0.0
+        self._frequencies = None
+        self._phases = None
 
     @property
     def amplitude(self):
@@ -103,12 +171,47 @@ class SineSource(Device):
     @frequency.setter
     def frequency(self, value):
         self._frequency = float(value)
+        self._frequencies = None
+        self._phases = None
+
+    @property
+    def frequencies(self):
+        if self._frequencies is None:
+            return np.array([self.frequency])
+        return self._frequencies.copy()
+
+    @frequencies.setter
+    def frequencies(self, value):
+        # multisine: every tone has the full amplitude, the schroeder phases
+        # keep the crest factor of the sum low
+        value = np.array(value, dtype=float).ravel()
+        k = np.arange(len(value))
+        self._frequencies = value
+        self._phases = -np.pi*k*(k - 1)/len(value)
+        self._frequency = value[0]
+
+    @property
+    def phases(self):
+        if self._phases is None:
+            return np.zeros(1)
+        return self._phases.copy()
 
     def _output(self, t, gain=1.0):
-        return self.amplitude*np.abs(gain) \
-            * np.cos(2*np.pi*self.frequency*np.asarray(t) + np.angle(gain))
+        if self._frequencies is None:
+            return self.amplitude*np.abs(gain) \
+                * np.cos(2*np.pi*self.frequency*np.asarray(t) + np.angle(gain))
+        gain = np.broadcast_to(gain, self._frequencies.shape)
+        out = np.zeros(np.shape(t))
+        for f, phase, g in zip(self._frequencies, self._phases, gain):
+            out += self.amplitude*np.abs(g) \
+                * np.cos(2*np.pi*f*np.asarray(t) + phase + np.angle(g))
+        return out
 
     def __str__(self):
+        if self._frequencies is not None:
+            return super().__str__() \
+                + f': amplitude={self.amplitude}' \
+                + f' tones={len(self._frequencies)}'
         return super().__str__() \
             + f': amplitude={self.amplitude}' \
             + f' frequency={self.frequency}'
@@ -135,6 +238,8 @@ class Oscilloscope(Device):
         self._filt = filt
         self._fs = 2.5e6
         self._nsamples = 100000
+        self._noise = 0.0
+        self._rng = np.random.default_rng()
 
     @property
     def sample_rate(self):
@@ -144,12 +249,33 @@ class Oscilloscope(Device):
     def nsamples(self):
         return self._nsamples
 
+    @nsamples.setter
+    def nsamples(self, value):
+        if int(value) < 2:
+            raise ValueError('at least two samples are needed')
+        self._nsamples = int(value)
+
+    @property
+    def noise(self):
+        return self._noise
+
+    @noise.setter
+    def noise(self, value):
+        # standard deviation of the gaussian noise added to both channels
+        if float(value) < 0:
+            raise ValueError('the noise can not be negative')
+        self._noise = float(value)
+
     def waveforms(self):
         t = np.arange(self.nsamples)/self._fs - (self.nsamples - 1)/2/self._fs
-        gain = self._filt._tf(self._source.frequency)
-        cable = np.exp(2j*np.pi*self._source.frequency*15.0/3e8)
+        f = self._source.frequencies
+        gain = self._filt._tf(f)
+        cable = np.exp(2j*np.pi*f*15.0/3e8)
         ch1 = self._source._output(t, gain=1.0*cable)
         ch2 = self._source._output(t, gain=gain*cable)
+        if self._noise > 0:
+            ch1 = ch1 + self._rng.normal(scale=self._noise, size=ch1.shape)
+            ch2 = ch2 + self._rng.normal(scale=self._noise, size=ch2.shape)
         return t, ch1, ch2
 
     def __str__(self):
@@ -163,15 +289,134 @@ sine_source = SineSource()
 oscilloscope = Oscilloscope(source=sine_source, filt=Filter())
 
 
+# all devices which can be opened, keyed by their address
+_devices = {0x73CC: voltage_source,
+            0x4D1E: ampere_meter,
+            0x198A: volt_meter,
+            0xC34F: sine_source,
+            0xDC31: oscilloscope,
+            }
+
+
+def register_device(addr, device):
+    if not isinstance(addr, int):
+        raise TypeError(f'addr is not an integer')
+    if addr in _devices:
+        raise ValueError(f'address 0x{addr:04X} is already in use')
+    _devices[addr] = device
+
+
+def unregister_device(addr):
+    if not isinstance(addr, int):
+        raise TypeError(f'addr is not an integer')
+    if addr not in _devices:
+        raise ValueError(f'no device with address 0x{addr:04X} found')
+    del _devices[addr]
+
+
 def open_device(addr):
-    devices = {0x73CC: voltage_source,
-               0x4D1E: ampere_meter,
-               0x198A: volt_meter,
-               0xC34F: sine_source,
-               0xDC31: oscilloscope,
-               }
     if not isinstance(addr, int):
         raise TypeError(f'addr is not an integer')
-    if addr not in devices:
+    if addr not in _devices:
         raise ValueError(f'no device with address 0x{addr:04X} found')
-    return devices[addr]
+    return _devices[addr]
+
+
+# --- asynchronous drivers ----------------------------------------------------
+class AsyncDevice:
+    def __init__(self, device, latency=0.0):
+        self._device = device
+        self._latency = float(latency)
+
+    @property
+    def latency(self):
+        return self._latency
+
+    async def _transaction(self):
+        # simulated time of one instrument transaction
+        await asyncio.sleep(self._latency)
+
+    def __str__(self):
+        return f'Async {self._device}'
+
+
+class AsyncVoltageSource(AsyncDevice):
+    def __init__(self, device, latency=0.0):
+        if not isinstance(device, VoltageSource):
+            raise TypeError('the device is not a voltage source')
+        super().__init__(device, latency)
+
+    async def set_voltage(self, value):
+        await self._transaction()
+        self._device.voltage = value
+
+
+class AsyncVoltMeter(AsyncDevice):
+    def __init__(self, device, latency=0.0):
+        if not isinstance(device, VoltMeter):
+            raise TypeError('the device is not a volt meter')
+        super().__init__(device, latency)
+
+    async def measure(self):
+        await self._transaction()
+        return self._device.measure()
+
+
+class AsyncAmpereMeter(AsyncDevice):
+    def __init__(self, device, latency=0.0):
+        if not isinstance(device, AmpereMeter):
+            raise TypeError('the device is not an ampere meter')
+        super().__init__(device, latency)
+
+    async def measure(self):
+        await self._transaction()
+        return self._device.measure()
+
+
+class AsyncSineSource(AsyncDevice):
+    def __init__(self, device, latency=0.0):
+        if not isinstance(device, SineSource):
+            raise TypeError('the device is not a sine source')
+        super().__init__(device, latency)
+
+    async def set_amplitude(self, value):
+        await self._transaction()
+        self._device.amplitude = value
+
+    async def set_frequency(self, value):
+        await self._transaction()
+        self._device.frequency = value
+
+
+class AsyncOscilloscope(AsyncDevice):
+    def __init__(self, device, latency=0.0):
+        if not isinstance(device, Oscilloscope):
+            raise TypeError('the device is not an oscilloscope')
+        super().__init__(device, latency)
+
+    @property
+    def sample_rate(self):
+        return self._device.sample_rate
+
+    @property
+    def nsamples(self):
+        return self._device.nsamples
+
+    async def waveforms(self):
+        await self._transaction()
+        # the simulated capture runs in a thread, so it doesn't block the
+        # other instruments in the event loop
+        return await asyncio.to_thread(self._device.waveforms)
+
+
+def open_async_device(addr, latency=0.0):
+    drivers = {VoltageSource: AsyncVoltageSource,
+               VoltMeter: AsyncVoltMeter,
+               AmpereMeter: AsyncAmpereMeter,
+               SineSource: AsyncSineSource,
+               Oscilloscope: AsyncOscilloscope,
+               }
+    device = open_device(addr)
+    if type(device) not in drivers:
+        raise TypeError(f'no asynchronous driver for 0x{addr:04X}')
+    return drivers[type(device)](device, latency=latency)
@@ -1,10 +1,100 @@
+import asyncio
+import contextlib
+import hashlib
+import json
 import math
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 from scipy import interpolate
-from scipy.misc import derivative
+from dateien.devices import open_device
 
+# files with this extension are saved as binary archives, see save_archive
+ARCHIVE_EXTENSION = ".t2a"
+_ARCHIVE_MAGIC = b"TESTAT2A"
+_ARCHIVE_ALIGNMENT = 64
+# comment line holding the metadata of text files, see save_data
+_METADATA_PREFIX = "# metadata: "
 
-def vi_characteristic(v_source, v_meter, a_meter, source_voltage):
+
+class SweepMetrics:
+    """Records the duration and counters (samples, rows, bytes) of the
+    stages of a sweep. Pass it as metrics to vi_characteristic,
+    iq_measurements (or its pipelined, async and multisine variants),
+    save_data or load_data. Without metrics these functions only do a
+    no-op call per stage.
+
+    Parameters
+    ----------
+    hook : object
+        A function called with every record right after its stage ended,
+        e.g. for live logging.
+
+
+    Example
+    -------
+    metrics = SweepMetrics()\n
+    I1, Q1, I2, Q2 = iq_measurements(source=source, scope=scope, f=f,
+    amplitude=1.0, metrics=metrics)\n
+    print(metrics.summary()["acquisition"]["duration"])
+    """
+
+    def __init__(self, hook=None):
+        self.records = []
+        self._hook = hook
+
+    @contextlib.contextmanager
+    def stage(self, name, **counters):
+        """Measures the duration of the with block. The yielded dict is the
+        record, counters can be added to it inside the block."""
+        record = {"stage": name, **counters}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["duration"] = time.perf_counter() - start
+            self.records.append(record)
+            if self._hook is not None:
+                self._hook(record)
+
+    def summary(self):
+        """Returns the number of records and the sums of the duration and
+        all counters per stage."""
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record["stage"], {"count": 0})
+            total["count"] += 1
+            for key, value in record.items():
+                if key != "stage":
+                    total[key] = total.get(key, 0) + value
+        return stages
+
+    def to_records(self):
+        """Returns a copy of all records as list of dicts."""
+        return [dict(record) for record in self.records]
+
+    def clear(self):
+        self.records = []
+
+
+class _NullMetrics:
+    """Used when no metrics are given, records nothing."""
+
+    def stage(self, name, **counters):
+        return contextlib.nullcontext({})
+
+
+_NULL_METRICS = _NullMetrics()
+
+
+def vi_characteristic(v_source, v_meter, a_meter, source_voltage,
+                      batch=False, cache=None, metrics=None,
+                      check_monotonic=False):
     """Measures the vi characteristic of a device under test. returns
 
     Parameters
@@ -21,6 +111,24 @@ def vi_characteristic(v_source, v_meter, a_meter, source_voltage):
     source_voltage : list
         The Amplitude with which the entire measurement will be done.
 
+    batch : bool
+        If True the meters measure all source voltages at once with their
+        measure_sweep method instead of one point after the other.
+
+    cache : object
+        A MeasurementCache. Only the source voltages which are not in the
+        cache are measured, the new points are added to the cache.
+
+    metrics : object
+        A SweepMetrics recording the stages "settle" and "measure".
+
+    check_monotonic : bool
+        If True the sweep is aborted with a ValueError as soon as the curve
+        is not strictly monotonic anymore. Cached points are checked in
+        order with the measured ones. In batch mode the voltages measured
+        together (all of them, or the missing ones between two cached
+        points) are only checked after the batch.
+
     Returns
     -------
     object
@@ -34,20 +142,328 @@ def vi_characteristic(v_source, v_meter, a_meter, source_voltage):
     res = vi_characteristic(v_source=v_source, v_meter=v_meter,
     a_meter=a_meter, source_voltage=source_voltage)
     """
+    if metrics is None:
+        metrics = _NULL_METRICS
+
+    if cache is not None:
+        source_voltage = np.asarray(source_voltage, dtype=float)
+        rows = [cache.get(voltage) for voltage in source_voltage]
+        checker = MonotonicChecker()
+        for index in range(len(rows)):
+            if rows[index] is None:
+                # in batch mode all missing voltages up to the next cached
+                # one are measured at once, otherwise only this one, so the
+                # sweep can stop at the first violation
+                stop = index + 1
+                while batch and stop < len(rows) and rows[stop] is None:
+                    stop += 1
+                measured = vi_characteristic(v_source, v_meter, a_meter,
+                                             source_voltage[index:stop],
+                                             batch=batch, metrics=metrics)
+                for i, row in zip(range(index, stop), measured):
+                    cache.put(source_voltage[i], row)
+                    rows[i] = row
+            if check_monotonic and not checker.add(rows[index]):
+                raise ValueError("the characteristic curve is not strictly "
+                                 f"monotonic at index {checker.violation}")
+        return np.array(rows).reshape(len(rows), 2)
+
+    if batch:
+        if not (hasattr(v_meter, "measure_sweep")
+                and hasattr(a_meter, "measure_sweep")):
+            raise TypeError("the meters do not support batch measurements")
+        source_voltage = np.asarray(source_voltage, dtype=float)
+        if len(source_voltage) > 0:
+            v_source.voltage = source_voltage[-1]
+        with metrics.stage("measure", samples=len(source_voltage)):
+            vi = np.c_[v_meter.measure_sweep(source_voltage),
+                       a_meter.measure_sweep(source_voltage)]
+        if check_monotonic:
+            _check_monotonic(vi)
+        return vi
 
     # Initialise an array
     voltage_current_list = []
+    checker = MonotonicChecker()
 
     # Do all the measurements with the specified source_voltage
-    for voltage in source_voltage:
-        v_source.voltage = voltage
-        new_row_in_array = [v_meter.measure(), a_meter.measure()]
+    for new_row_in_array in iter_vi_characteristic(
+            v_source, v_meter, a_meter, source_voltage, metrics):
+        if check_monotonic and not checker.add(new_row_in_array):
+            raise ValueError("the characteristic curve is not strictly "
+                             f"monotonic at index {checker.violation}")
         voltage_current_list.append(new_row_in_array)
 
     # Convert the array to an 2D numpy array
     return np.array(voltage_current_list)
 
 
+def _check_monotonic(vi):
+    """Helper function raises a ValueError if vi is not strictly
+    monotonic."""
+    violations = [index for index in monotonic_violation(vi.T) if index != -1]
+    if len(violations) > 0:
+        raise ValueError("the characteristic curve is not strictly "
+                         f"monotonic at index {min(violations)}")
+
+
+def iter_vi_characteristic(v_source, v_meter, a_meter, source_voltage,
+                           metrics=None):
+    """Measures the vi characteristic of a device under test like
+    vi_characteristic, but yields every point as soon as it is measured.
+
+    Parameters
+    ----------
+    v_source : object
+        The voltage supply used for the experiment.
+
+    v_meter : object
+        The voltage meter used for the experiment.
+
+    a_meter : object
+        The current meter used for the experiment.
+
+    source_voltage : list
+        The source voltages at which to measure.
+
+    metrics : object
+        A SweepMetrics recording the stages "settle" and "measure".
+
+    Yields
+    ------
+    list
+        [V, I] of one source voltage
+
+
+    Example
+    -------
+    for v, i in iter_vi_characteristic(v_source=v_source, v_meter=v_meter,
+    a_meter=a_meter, source_voltage=np.linspace(0, 5, 26)):\n
+        print(v, i)
+    """
+    if metrics is None:
+        metrics = _NULL_METRICS
+
+    for voltage in source_voltage:
+        with metrics.stage("settle"):
+            v_source.voltage = voltage
+        with metrics.stage("measure", samples=1):
+            new_row_in_array = [v_meter.measure(), a_meter.measure()]
+        yield new_row_in_array
+
+
+async def vi_characteristic_async(v_source, v_meter, a_meter,
+                                  source_voltage):
+    """Measures the vi characteristic of a device under test with
+    asynchronous drivers (see open_async_device). Both meters are read at
+    the same time.
+
+    Parameters
+    ----------
+    v_source : object
+        The asynchronous voltage supply used for the experiment.
+
+    v_meter : object
+        The asynchronous voltage meter used for the experiment.
+
+    a_meter : object
+        The asynchronous current meter used for the experiment.
+
+    source_voltage : list
+        The source voltages at which to measure.
+
+    Returns
+    -------
+    object
+        a 2D numpy array with the voltage in the first column and current in
+        the second.
+
+
+    Example
+    -------
+    source_voltage = np.linspace(0, 5, 26)\n
+    res = asyncio.run(vi_characteristic_async(v_source=v_source,
+    v_meter=v_meter, a_meter=a_meter, source_voltage=source_voltage))
+    """
+    voltage_current_list = []
+    for voltage in source_voltage:
+        await v_source.set_voltage(voltage)
+        voltage_current_list.append(
+            await asyncio.gather(v_meter.measure(), a_meter.measure()))
+    return np.array(voltage_current_list)
+
+
+def adaptive_vi_characteristic(v_source, v_meter, a_meter, source_voltage,
+                               tol=1e-3, max_points=100):
+    """Measures the vi characteristic of a device under test on an adaptive
+    grid. The sweep starts with the coarse grid source_voltage and measures
+    the midpoints of all intervals on which the linear interpolation of the
+    current is estimated to be worse than tol. The estimate is the local
+    curvature (second divided difference) times the squared interval width,
+    or a quarter of the interpolation error measured at the midpoint when
+    the interval was created, whichever is larger.
+
+    Parameters
+    ----------
+    v_source : object
+        The voltage supply used for the experiment.
+
+    v_meter : object
+        The voltage meter used for the experiment.
+
+    a_meter : object
+        The current meter used for the experiment.
+
+    source_voltage : list
+        The source voltages of the coarse grid.
+
+    tol : float
+        The maximal interpolation error of the current.
+
+    max_points : int
+        The maximal number of measured points.
+
+    Returns
+    -------
+    object
+        a 2D numpy array with the voltage in the first column and current in
+        the second, sorted by the source voltage.
+
+
+    Example
+    -------
+    source_voltage = np.linspace(0, 5, 6)\n
+    res = adaptive_vi_characteristic(v_source=v_source, v_meter=v_meter,
+    a_meter=a_meter, source_voltage=source_voltage, tol=1e-3)
+    """
+    sv = np.unique(np.asarray(source_voltage, dtype=float))
+    if len(sv) < 2:
+        raise ValueError("at least two source voltages are needed")
+    vi = vi_characteristic(v_source, v_meter, a_meter, sv)
+
+    # interpolation error measured when an interval was created
+    measured_error = np.zeros(len(sv) - 1)
+
+    while len(sv) < max_points:
+        estimate = np.maximum(_curvature_error(vi), measured_error / 4)
+        estimate[np.diff(sv) < 1e-9] = 0
+        intervals = np.flatnonzero(estimate > tol)
+        if len(intervals) == 0:
+            break
+
+        # the worst intervals are refined first
+        intervals = intervals[np.argsort(-estimate[intervals], kind="stable")]
+        intervals = np.sort(intervals[:max_points - len(sv)])
+        new_sv = (sv[intervals] + sv[intervals + 1]) / 2
+        new_vi = vi_characteristic(v_source, v_meter, a_meter, new_sv)
+
+        # compares the new points with the interpolation of the old curve
+        predicted = interpolation(vi, {"V": new_vi[:, 0]})["I"]
+        new_error = np.abs(new_vi[:, 1] - predicted)
+
+        # every refined interval is replaced by its two halves
+        sv = np.insert(sv, intervals + 1, new_sv)
+        vi = np.insert(vi, intervals + 1, new_vi, axis=0)
+        measured_error[intervals] = new_error
+        measured_error = np.insert(measured_error, intervals + 1, new_error)
+
+    return vi
+
+
+def _curvature_error(vi):
+    """Helper function estimates the linear interpolation error of every
+    interval of the vi characteristic curve from its local curvature."""
+    v = vi[:, 0]
+    i = vi[:, 1]
+    h = np.diff(v)
+    if len(v) < 3:
+        return np.full(len(h), np.inf)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.diff(i) / h
+        second_difference = np.abs(np.diff(slope) / (v[2:] - v[:-2]))
+    second_difference = np.nan_to_num(second_difference, posinf=0.0)
+
+    # every interval uses the larger curvature of its two neighbouring triples
+    curvature = np.zeros(len(h))
+    curvature[:-1] = second_difference
+    curvature[1:] = np.maximum(curvature[1:], second_difference)
+
+    # error of the linear interpolation in the middle: f'' / 8 * h^2
+    return curvature * h ** 2 / 4
+
+
+def run_stations(stations, sweep, max_workers=None):
+    """Runs a sweep on several measurement stations at the same time. Every
+    station is a dict mapping the argument names of sweep to device
+    addresses. The devices are opened with open_device and a station only
+    starts when it holds the locks of all its devices, so an instrument is
+    never used by two sweeps at once.
+
+    Parameters
+    ----------
+    stations : dict
+        The stations keyed by their name. Each station is a dict with the
+        device addresses, e.g. {"source": 0xC34F, "scope": 0xDC31}.
+
+    sweep : object
+        A function called with the opened devices of a station as keyword
+        arguments, its return value is the result of the station.
+
+    max_workers : int
+        The maximal number of stations measuring at once, None runs all
+        stations at once.
+
+
+    Returns
+    -------
+    dict
+        The results of the sweeps keyed by the station names.
+
+
+    Example
+    -------
+    f = np.logspace(3, 6, 31)\n
+    res = run_stations({"bench 1": {"source": 0xC34F, "scope": 0xDC31}},
+    lambda source, scope: iq_measurements(source, scope, f, 1.0))
+    """
+    if len(stations) == 0:
+        return {}
+
+    # opens all devices first, so a wrong address fails before measuring
+    devices = {name: {role: open_device(addr) for role, addr in
+                      station.items()} for name, station in stations.items()}
+
+    def run(name):
+        # the locks are always taken in the order of the addresses, this
+        # way two stations sharing devices can not deadlock
+        locks = [_device_lock(addr) for addr in sorted(set(
+            stations[name].values()))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            return sweep(**devices[name])
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    with ThreadPoolExecutor(
+            max_workers=max_workers or len(stations)) as executor:
+        futures = {name: executor.submit(run, name) for name in stations}
+        return {name: future.result() for name, future in futures.items()}
+
+
+# one lock per device address used by run_stations
+_device_locks = {}
+_device_locks_lock = threading.Lock()
+
+
+def _device_lock(addr):
+    """Helper function returns the lock of the device with the address."""
+    with _device_locks_lock:
+        return _device_locks.setdefault(addr, threading.Lock())
+
+
 def is_strictly_monotonic(vi):
     """Checks if the characteristic curve stored in the  2D numpy array is
         strictly monotonic.
@@ -56,59 +472,185 @@ def is_strictly_monotonic(vi):
     ----------
     vi : object
         is an 2D numpy array with two rows. The first row contains the
-        voltage the second row the corresponding current.
+        voltage the second row the corresponding current. A 3D numpy array
+        contains a batch of such curves.
 
     Returns
     -------
     bool
-        a bool if true -> the characteristic curve is strictly monotonic
+        a bool if true -> the characteristic curve is strictly monotonic.
+        For a batch a 1D numpy array with one bool per curve.
 
 
     Example
     -------
     is_strictly_monotonic(vi=np.c_[[3, 2, 1], [30, 25, 10]])
     """
-    return monotonic_direction_detection(
-        vi[:, 0]) and monotonic_direction_detection(vi[:, 1])
+    vi = np.asarray(vi)
+    res = (monotonic_violation(vi[..., 0]) == -1) \
+        & (monotonic_violation(vi[..., 1]) == -1)
+    return bool(res) if vi.ndim == 2 else res
+
+
+def monotonic_violation(curves):
+    """Finds the first point which breaks the strict monotony of a curve.
+    The direction is given by the first two points, two equal points at
+    the start are a violation as well.
+
+    Parameters
+    ----------
+    curves : object
+        a 1D numpy array or a 2D numpy array with one curve per row.
+
+    Returns
+    -------
+    int
+        the index of the first violating point or -1 if the curve is
+        strictly monotonic. For 2D input a 1D numpy array with one index per
+        curve.
+
+
+    Example
+    -------
+    monotonic_violation(np.array([[1, 2, 3], [1, 3, 2]])) # [-1, 2]
+    """
+    curves = np.asarray(curves, dtype=float)
+    d = np.sign(np.diff(curves, axis=-1))
+    if d.shape[-1] == 0:
+        return np.full(curves.shape[:-1], -1)[()]
+
+    direction = d[..., :1]
+    bad = (d != direction) | (direction == 0)
+    return np.where(bad.any(axis=-1), bad.argmax(axis=-1) + 1, -1)[()]
 
 
 def monotonic_direction_detection(vi_column):
     """Helper function checks if the first two numbers of vi_column are
-    either ascending or descending. Depending on this, calls the correct
-    function to check the rest of the column. """
-    if vi_column[0] > vi_column[1]:
-        return is_strictly_monotonic_decreasing(vi_column)
-    elif vi_column[0] < vi_column[1]:
-        return is_strictly_monotonic_increasing(vi_column)
-    else:
-        return False
+    either ascending or descending and the rest of the column follows this
+    direction. """
+    return bool(monotonic_violation(vi_column) == -1)
 
 
 def is_strictly_monotonic_increasing(vi_column):
     """Helper function to check if a 1D numpy array is strictly monotonic
     increasing """
-    previous_line = vi_column[0]
-    for numb in vi_column[1:]:
-        if previous_line >= numb:
-            return False
-        else:
-            previous_line = numb
-    return True
+    return bool(np.all(np.diff(vi_column) > 0))
 
 
 def is_strictly_monotonic_decreasing(vi_column):
     """Helper function to check if a 1D numpy array is strictly monotonic
         decreasing """
-    previous_line = vi_column[0]
-    for numb in vi_column[1:]:
-        if previous_line <= numb:
+    return bool(np.all(np.diff(vi_column) < 0))
+
+
+class MonotonicChecker:
+    """Checks the strict monotony of a curve while it is measured, one
+    point after the other. All columns of a point (e.g. V and I) have to be
+    strictly monotonic.
+
+    Example
+    -------
+    checker = MonotonicChecker()\n
+    for point in iter_vi_characteristic(v_source=v_source, v_meter=v_meter,
+    a_meter=a_meter, source_voltage=source_voltage):\n
+        if not checker.add(point):\n
+            break
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.violation = -1
+        self._last = None
+        self._direction = None
+
+    def add(self, point):
+        """Adds the next point, returns False once the curve is not
+        strictly monotonic anymore."""
+        point = np.atleast_1d(np.asarray(point, dtype=float))
+        index = self.count
+        self.count += 1
+        if self.violation != -1:
             return False
-        else:
-            previous_line = numb
-    return True
 
+        if self._last is not None:
+            d = np.sign(point - self._last)
+            if self._direction is None:
+                self._direction = d
+            if np.any(d != self._direction) or np.any(self._direction == 0):
+                self.violation = index
+                return False
+        self._last = point
+        return True
+
+    @property
+    def is_monotonic(self):
+        return self.violation == -1
+
+
+class VICurve:
+    """Interpolator for a 2D vi characteristic curve. The curve is sorted
+    once along both axes and the slope and intercept of every segment are
+    stored, so large batches of points can be looked up with a binary
+    search. Points outside the curve are extrapolated with the first or last
+    segment.
+
+    Parameters
+    ----------
+    vi : object
+        is an 2D numpy array with two rows. The first row contains the voltage
+        the second row the corresponding current.
+
+
+    Example
+    -------
+    curve = VICurve(np.c_[[1, 2.5, 8], [10, 12, 20]])\n
+    i = curve.current([1.4, 1.8, 4])\n
+    v = curve.voltage([11.1, 18], extrapolate=False)
+    """
 
-def interpolation(vi, points):
+    def __init__(self, vi):
+        vi = np.asarray(vi, dtype=float)
+        if vi.ndim != 2 or vi.shape[1] != 2 or len(vi) < 2:
+            raise ValueError("vi has to be a 2D array with at least two "
+                             "points and two columns")
+        self._v_axis = self._segments(vi[:, 0], vi[:, 1])
+        self._i_axis = self._segments(vi[:, 1], vi[:, 0])
+
+    @staticmethod
+    def _segments(x, y):
+        """Helper function sorts the curve along x and calculates the slope
+        and intercept of every segment."""
+        order = np.argsort(x, kind="stable")
+        x = x[order]
+        y = y[order]
+        slope = np.diff(y) / np.diff(x)
+        intercept = y[:-1] - slope * x[:-1]
+        return x, slope, intercept
+
+    @staticmethod
+    def _lookup(axis, points, extrapolate):
+        """Helper function does the linear interpolation of all points on
+        the given axis."""
+        x, slope, intercept = axis
+        points = np.asarray(points, dtype=float)
+        if not extrapolate and np.any((points < x[0]) | (points > x[-1])):
+            raise ValueError("point outside of the characteristic curve")
+
+        # index of the segment, the first and last segment are used for
+        # extrapolation
+        index = np.clip(np.searchsorted(x, points), 1, len(x) - 1) - 1
+        return slope[index] * points + intercept[index]
+
+    def current(self, voltage, extrapolate=True):
+        """Returns the interpolated currents at the given voltages."""
+        return self._lookup(self._v_axis, voltage, extrapolate)
+
+    def voltage(self, current, extrapolate=True):
+        """Returns the interpolated voltages at the given currents."""
+        return self._lookup(self._i_axis, current, extrapolate)
+
+
+def interpolation(vi, points, extrapolate=True):
     """On an given 2D vi characteristic curve this function can interpolate
     between the closest two points. If the desired point is outside the
     points in the vi characteristic curve the function will extrapolate.
@@ -123,6 +665,9 @@ def interpolation(vi, points):
         is a dictionary with one or two keys ("V", "I"). Each key has a 1D
         numpy array with the points which have to be interpolated.
 
+    extrapolate : bool
+        If False a ValueError is raised for points outside the curve.
+
     Returns
     -------
     dict
@@ -137,39 +682,27 @@ def interpolation(vi, points):
     res = interpolation(vi, {"V": [1.4, 1.8, 4], "I": [11.1, 18]})
     """
     list_of_interpolated_values = {}
-    for line in points:
-        if line == "V":
-            interpolated_values = []
-            for point in points[line]:
-                closest_point = find_closest_points_on_x_axis(vi, point)
-                res = linear_interpolation_x_axis(closest_point[0],
-                                                  closest_point[1], point)
-                interpolated_values.append(res)
-            list_of_interpolated_values["I"] = np.array(interpolated_values)
-
-        if line == "I":
-            interpolated_values = []
-            for point in points[line]:
-                closest_point = find_closest_points_on_y_axis(vi, point)
-                res = linear_interpolation_y_axis(closest_point[0],
-                                                  closest_point[1], point)
-                interpolated_values.append(res)
-            list_of_interpolated_values["V"] = np.array(interpolated_values)
+    if len(points) == 0:
+        return list_of_interpolated_values
+
+    curve = VICurve(vi)
+    if "V" in points:
+        list_of_interpolated_values["I"] = curve.current(points["V"],
+                                                         extrapolate)
+    if "I" in points:
+        list_of_interpolated_values["V"] = curve.voltage(points["I"],
+                                                         extrapolate)
     return list_of_interpolated_values
 
 
 def find_closest_points_on_x_axis(vi, point):
     """Helper function finds the closest two points in vi (characteristic
     curve) on the X axis (Voltage) to the desired voltage."""
-    higher_index = 0
-    while vi[:, 0][higher_index] < point and higher_index < len(vi[:, 0]):
-        higher_index += 1
+    higher_index = np.searchsorted(vi[:, 0], point)
 
     # if the point is outside the values given in the vi array this function
     # will return the two closes numbers (Extrapolating)
-    if higher_index == 0:
-        print("Extrapolating!")
-        higher_index = 1
+    higher_index = min(max(higher_index, 1), len(vi) - 1)
 
     closest_points = [vi[higher_index - 1], vi[higher_index]]
     return np.array(closest_points)
@@ -178,15 +711,11 @@ def find_closest_points_on_x_axis(vi, point):
 def find_closest_points_on_y_axis(vi, point):
     """Helper function finds the closest two points in vi (characteristic
        curve) on the Y axis (Current) to the desired current."""
-    higher_index = 0
-    while vi[:, 1][higher_index] < point and higher_index < len(vi[:, 1]):
-        higher_index += 1
+    higher_index = np.searchsorted(vi[:, 1], point)
 
     # if the point is outside the values given in the vi array this function
     # will return the two closes numbers (Extrapolating)
-    if higher_index == 0:
-        print("Extrapolating!")
-        higher_index = 1
+    higher_index = min(max(higher_index, 1), len(vi) - 1)
 
     closest_points = [vi[higher_index - 1], vi[higher_index]]
     return np.array(closest_points)
@@ -208,8 +737,15 @@ def linear_interpolation_y_axis(point_one, point_two, y_value):
     return (y_value - b) / a
 
 
-def iq_measurements(source, scope, f, amplitude):
-    """Measures the time dependent signals of the DUT.
+def iq_measurements(source, scope, f, amplitude, periods=None,
+                    min_samples=1000, cache=None, metrics=None, averages=1,
+                    target_stderr=None):
+    """Measures the time dependent signals of the DUT. By default every
+    frequency is captured with the nsamples set on the scope. If periods is
+    given, the scope only captures about this number of periods per
+    frequency (see acquisition_length), but never more samples than the
+    nsamples set on the scope. On the simulated setup periods=10 changes
+    I/Q by less than 1e-5 compared to full captures.
 
     Parameters
     ----------
@@ -225,11 +761,36 @@ def iq_measurements(source, scope, f, amplitude):
     amplitude : float
         The Amplitude with which the entire measurement will be done.
 
+    periods : float
+        The number of periods captured per frequency. None captures
+        scope.nsamples samples at every frequency.
+
+    min_samples : int
+        The minimal number of samples per capture if periods is given.
+
+    cache : object
+        A MeasurementCache. Only the frequencies which are not in the cache
+        for the same amplitude and acquisition settings are measured, the
+        new points are added to the cache.
+
+    metrics : object
+        A SweepMetrics recording the stages "settle", "acquisition" and
+        "demodulation".
+
+    averages : int
+        The maximal number of captures averaged per frequency. Only the
+        running mean and variance of I/Q are kept, not the waveforms.
+
+    target_stderr : float
+        If given, the averaging of a frequency stops as soon as the standard
+        errors of all four I/Q values are below it.
+
 
     Returns
     -------
     list
-        A list containing 4 numpy array I1, Q1, I2, Q2
+        A list containing 4 numpy array I1, Q1, I2, Q2. If averages > 1 the
+        standard errors of I1, Q1, I2, Q2 follow as 4 more numpy arrays.
 
 
     Example
@@ -238,249 +799,1644 @@ def iq_measurements(source, scope, f, amplitude):
     I1, Q1, I2, Q2 = iq_measurements(source=source, scope=scope, f=f,
     amplitude=1.0)
     """
-
-    # setting the source amplitude
-    source.amplitude = amplitude
+    if averages < 1:
+        raise ValueError("at least one capture per frequency is needed")
+    if metrics is None:
+        metrics = _NULL_METRICS
+    n_values = 8 if averages > 1 else 4
+
+    if cache is not None:
+        f = np.asarray(f, dtype=float)
+        settings = {"amplitude": float(amplitude),
+                    "sample_rate": float(scope.sample_rate),
+                    "nsamples": int(scope.nsamples),
+                    "periods": periods,
+                    "min_samples": min_samples,
+                    "averages": averages,
+                    "target_stderr": target_stderr}
+        iq = [cache.get(frequency, settings) for frequency in f]
+        missing = [i for i, point in enumerate(iq) if point is None]
+        if len(missing) > 0:
+            measured = iq_measurements(source, scope, f[missing], amplitude,
+                                       periods, min_samples, metrics=metrics,
+                                       averages=averages,
+                                       target_stderr=target_stderr)
+            for i, point in zip(missing, np.transpose(measured)):
+                cache.put(f[i], point, settings)
+                iq[i] = point
+        iq = np.array(iq).reshape(len(iq), n_values)
+        return [np.array(column) for column in iq.T]
 
     # initialise the arrays
-    list_of_i1 = []
-    list_of_q1 = []
-    list_of_i2 = []
-    list_of_q2 = []
-
-    # loop through all frequency in the f array
-    for frequency in f:
-
-        # Could be removed, but due to the rather long time this function is
-        # running, it is nice to see some console logging.
-        print("Measuring at frequency = ", frequency)
-
-        # sets the current frequency
-        source.frequency = frequency
-
-        # reads the samples measured in the following measurement
-        n = scope.nsamples
-
-        # does the measurement
-        t, c1, c2 = scope.waveforms()
-
-        # calculates the hanning window
-        h = np.hanning(n)
-
-        sum_i1 = 0
-        sum_q1 = 0
-        sum_i2 = 0
-        sum_q2 = 0
-
-        # calculates i1 q1 i2 q2
-        for i in range(len(t)):
-            sum_i1 += c1[i] * h[i] * math.cos(2 * math.pi * frequency * t[i])
-            sum_q1 += c1[i] * h[i] * math.sin(-2 * math.pi * frequency * t[i])
-            sum_i2 += c2[i] * h[i] * math.cos(2 * math.pi * frequency * t[i])
-            sum_q2 += c2[i] * h[i] * math.sin(-2 * math.pi * frequency * t[i])
-        i1 = (4 / (n - 1)) * sum_i1
-        q1 = (4 / (n - 1)) * sum_q1
-        i2 = (4 / (n - 1)) * sum_i2
-        q2 = (4 / (n - 1)) * sum_q2
-        list_of_i1.append(i1)
-        list_of_q1.append(q1)
-        list_of_i2.append(i2)
-        list_of_q2.append(q2)
-
-    # returns the lists as numpy arrays
-    return [np.array(list_of_i1), np.array(list_of_q1), np.array(list_of_i2),
-            np.array(list_of_q2)]
-
-
-def frequency_response(i1, q1, i2, q2):
-    """Calculates the frequency response with the measurements gathered in
-    the function iq_measurements. These two arrays can be plotted as
-    the Bode plot.
-
-    Parameters
-    ----------
-    i1 : list
-        I1 of the I/Q Values
-
-    q1 : list
-        Q1 of the I/Q Values
+    list_of_values = []
 
-    i2 : list
-        I2 of the I/Q Values
-
-    q2 : list
-        Q2 of the I/Q Values
+    for record in iter_iq_measurements(source, scope, f, amplitude, periods,
+                                       min_samples, metrics, averages,
+                                       target_stderr):
+        list_of_values.append(record[1:])
 
+    # returns one numpy array per value
+    iq = np.array(list_of_values, dtype=float).reshape(len(list_of_values),
+                                                        n_values)
+    return [np.array(column) for column in iq.T]
 
-    Returns
-    -------
-    list
-        A list containing two numpy array A & Phi:
-        A is a 1D numpy array containing the amplitude at different
-        frequencies. Phi is a 1D numpy array containing the phase at different
-        frequencies.
 
+class RunningStatistics:
+    """Running mean and variance (Welford) of repeated measurements of one
+    or more values, the measurements themselves are not stored.
 
     Example
     -------
-    A, Phi = frequency_response(I1, Q1, I2, Q2)
+    statistics = RunningStatistics()\n
+    statistics.update([1.0, 2.0])\n
+    statistics.update([3.0, 2.0])\n
+    statistics.mean, statistics.standard_error
     """
 
-    a = []
-    phi = []
-    for i in range(len(i1)):
-        amp = (math.sqrt(math.pow(i2[i], 2) + math.pow(q2[i], 2))) / (
-            math.sqrt(math.pow(i1[i], 2) + math.pow(q1[i], 2)))
-        phase = math.atan2(q2[i], i2[i]) - math.atan2(q1[i], i1[i])
-        a.append(amp)
-        phi.append(phase)
-    return [np.array(a), np.array(phi)]
+    def __init__(self):
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        self.count += 1
+        if self._mean is None:
+            self._mean = values.copy()
+            self._m2 = np.zeros_like(values)
+            return
+        delta = values - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (values - self._mean)
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def variance(self):
+        """The sample variance, zero as long as there is only one value."""
+        if self.count < 2:
+            return np.zeros_like(self._mean)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def standard_error(self):
+        return np.sqrt(self.variance / self.count)
+
+
+def iter_iq_measurements(source, scope, f, amplitude, periods=None,
+                         min_samples=1000, metrics=None, averages=1,
+                         target_stderr=None):
+    """Measures the time dependent signals of the DUT like iq_measurements,
+    but yields every frequency as soon as it is demodulated. The next
+    frequency is only measured when the consumer asks for it.
 
+    Parameters
+    ----------
+    source : object
+        The Signal Generator used for the experiment.
 
-def group_delay(f, phi):
-    """Calculates the group delay of a given system
+    scope : object
+        The Scope used for the experiment.
 
-        Parameters
-        ----------
-        f : list
-            contains a list or 1D numpy array of frequencies
+    f : list
+        A list containing the frequencies at which to measure.
 
-        phi : list
-            contains a list or 1D numpy array of phase responses
+    amplitude : float
+        The Amplitude with which the entire measurement will be done.
 
-        Returns
-        -------
-        list
-            a 1D numpy array containing the group_delay at different
-            frequencies.
+    periods : float
+        The number of periods captured per frequency, see iq_measurements.
 
+    min_samples : int
+        The minimal number of samples per capture if periods is given.
 
-        Example
-        -------
-        f = np.logspace(3, 6, 31)\n
-        phi = -np.arctan(f*2*np.pi*3300*1.5e-9)\n
-        tau_g = group_delay(phi, f)
-        """
+    metrics : object
+        A SweepMetrics recording the stages "settle", "acquisition" and
+        "demodulation".
 
-    list_of_group_delay = []
-    interpolated_function = interpolate.interp1d(
-        f, phi, fill_value="extrapolate")
+    averages : int
+        The maximal number of captures averaged per frequency.
 
-    for frequency in f:
-        list_of_group_delay.append((-(1 / (2 * math.pi))) * derivative(
-            interpolated_function, frequency))
-    return np.array(list_of_group_delay)
+    target_stderr : float
+        Stops the averaging of a frequency as soon as all standard errors
+        are below it.
 
 
-def save_data(fname, *args, labels=[]):
-    """Saves a unspecified number of measurements and saves them into a file.
+    Yields
+    ------
+    tuple
+        (f, I1, Q1, I2, Q2) of one frequency, followed by the standard
+        errors of I1, Q1, I2, Q2 if averages > 1
 
-            Parameters
-            ----------
-            fname : str
-                the file path where the file will be saved
 
-            *args : list
-                a list or 1D / 2D numpy array with measurements with
-                the same length
+    Example
+    -------
+    f = np.logspace(3, 6, 31)\n
+    for f, I1, Q1, I2, Q2 in iter_iq_measurements(source=source,
+    scope=scope, f=f, amplitude=1.0):\n
+        print(f, I1)
+    """
+    if averages < 1:
+        raise ValueError("at least one capture per frequency is needed")
+    if metrics is None:
+        metrics = _NULL_METRICS
 
-            labels : list
-                a list of strings which will be the headers for the columns
+    # setting the source amplitude
+    source.amplitude = amplitude
 
-            Example
-            -------
-            save_data("iq_data.txt", f, I1, Q1, I2, Q2) # f¨unf 1D Arrays
-            """
-    file_as_string = ""
-
-    if len(labels) > 0:
-        file_as_string += "# "
-        for header in labels:
-            file_as_string += str(header) + ","
-        file_as_string += "\n"
-
-    for i in range(len(args[0])):
-        line_in_file = ""
-        for line in args:
-            array = ""
-            try:
-                for element in line[i]:
-                    # Formatting the number to 6 digits after the comma
-                    array += str('{0:.6f}'.format(element)) + ","
-            except TypeError:
-                array = str('{0:.6f}'.format(line[i])) + ","
-            line_in_file += (str(array))
-        file_as_string += (line_in_file[:-1] + "\n")
-    print(file_as_string)
+    h = None
+    max_samples = scope.nsamples
+
+    try:
+        # loop through all frequency in the f array
+        for frequency in f:
+
+            # Could be removed, but due to the rather long time this function
+            # is running, it is nice to see some console logging.
+            print("Measuring at frequency = ", frequency)
+
+            with metrics.stage("settle"):
+                # sets the current frequency
+                source.frequency = frequency
+
+                # adapts the number of samples to the frequency
+                if periods is not None:
+                    scope.nsamples = acquisition_length(
+                        frequency, scope.sample_rate, periods, min_samples,
+                        max_samples)
+
+            # reads the samples measured in the following measurement
+            n = scope.nsamples
+            statistics = RunningStatistics()
+
+            for _ in range(averages):
+                # does the measurement
+                with metrics.stage("acquisition", samples=n):
+                    t, c1, c2 = scope.waveforms()
+
+                with metrics.stage("demodulation", samples=n):
+                    # the hanning window only has to be recalculated if the
+                    # number of samples changed since the last measurement
+                    if h is None or len(h) != n:
+                        h = np.hanning(n)
+
+                    # calculates i1 q1 i2 q2
+                    statistics.update(
+                        iq_demodulation(t, c1, c2, frequency, h))
+
+                if target_stderr is not None and statistics.count > 1 \
+                        and np.all(statistics.standard_error <= target_stderr):
+                    break
+
+            i1, q1, i2, q2 = statistics.mean
+            if averages > 1:
+                yield (frequency, i1, q1, i2, q2,
+                       *statistics.standard_error)
+            else:
+                yield frequency, i1, q1, i2, q2
+    finally:
+        if periods is not None:
+            scope.nsamples = max_samples
+
+
+def checkpointed_iq_measurements(source, scope, f, amplitude, checkpoint,
+                                 every=10, interval=None, resume=True,
+                                 periods=None, min_samples=1000):
+    """Measures the time dependent signals of the DUT like iq_measurements
+    and appends the measured points to a checkpoint file every `every`
+    points or `interval` seconds. If the sweep is interrupted, calling it
+    again with resume=True loads the checkpoint and only measures the
+    frequencies which are missing. The amplitude and the acquisition
+    settings are saved in the checkpoint as well, resuming with different
+    settings raises a ValueError.
 
-    f = open(fname, "w")
-    f.write(file_as_string)
-    f.close()
+    Parameters
+    ----------
+    source : object
+        The Signal Generator used for the experiment.
 
+    scope : object
+        The Scope used for the experiment.
 
-def load_data(fname, col_labels=False):
-    """Loads the measurement data from the specified file.
+    f : list
+        A list containing the frequencies at which to measure.
 
-        Parameters
-        ----------
-        fname : str
-            the file path where the file is saved
+    amplitude : float
+        The Amplitude with which the entire measurement will be done.
 
-        *col_labels : bool
-            specifies if the file contains a Header string
+    checkpoint : str
+        The file path of the checkpoint.
 
-        Returns
-        -------
-         list
-            when col_labels = False a 2D numpy array.
-            when col_label = True a 2D numpy array and a list with the headers
-            as string.
+    every : int
+        The number of points after which the checkpoint is written.
 
-        Example
+    interval : float
+        The time in seconds after which the checkpoint is written, None
+        only uses `every`.
+
+    resume : bool
+        If True the points in an existing checkpoint are reused, otherwise
+        the checkpoint is started from scratch.
+
+    periods : float
+        The number of periods captured per frequency, see iq_measurements.
+
+    min_samples : int
+        The minimal number of samples per capture if periods is given.
+
+
+    Returns
+    -------
+    list
+        A list containing 4 numpy array I1, Q1, I2, Q2
+
+
+    Example
+    -------
+    f = np.logspace(3, 6, 300)\n
+    I1, Q1, I2, Q2 = checkpointed_iq_measurements(source=source, scope=scope,
+    f=f, amplitude=1.0, checkpoint="iq_data.checkpoint.txt")
+    """
+    f = np.asarray(f, dtype=float)
+    labels = ["f", "I1", "Q1", "I2", "Q2"]
+    # everything besides the frequency which changes the measured points
+    settings = {"amplitude": float(amplitude),
+                "sample_rate": float(scope.sample_rate),
+                "nsamples": int(scope.nsamples),
+                "periods": None if periods is None else float(periods),
+                "min_samples": int(min_samples)}
+
+    # points measured before, keyed by the frequency
+    points = {}
+    if resume and os.path.exists(checkpoint) \
+            and os.path.getsize(checkpoint) > 0:
+        saved_settings = read_metadata(checkpoint)
+        if saved_settings != settings:
+            raise ValueError(f"the checkpoint {checkpoint} was measured with "
+                             f"{saved_settings}, not with {settings}, use "
+                             f"resume=False to start a new one")
+        saved = load_data(checkpoint, col_labels=True)[0]
+        for row in saved.T:
+            points[row[0]] = row[1:]
+    elif os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    missing = [frequency for frequency in f if frequency not in points]
+    pending = []
+    last_flush = time.monotonic()
+
+    def flush():
+        # the frequencies are saved without losing precision, so they can be
+        # matched again when resuming
+        save_data(checkpoint, pending, labels=labels, append=True,
+                  metadata=settings, fmt="%.17g")
+        pending.clear()
+
+    try:
+        for record in iter_iq_measurements(source, scope, missing, amplitude,
+                                           periods, min_samples):
+            points[record[0]] = np.array(record[1:])
+            pending.append(record)
+            if len(pending) >= every or (
+                    interval is not None
+                    and time.monotonic() - last_flush >= interval):
+                flush()
+                last_flush = time.monotonic()
+    finally:
+        # also keeps the last points if the sweep failed
+        if len(pending) > 0:
+            flush()
+
+    iq = np.array([points[frequency] for frequency in f]).reshape(len(f), 4)
+    return [iq[:, 0], iq[:, 1], iq[:, 2], iq[:, 3]]
+
+
+def acquisition_length(frequency, sample_rate, periods=10, min_samples=1000,
+                       max_samples=100000):
+    """Calculates the number of samples needed to capture a number of whole
+    periods of a frequency. If min_samples are more than periods, the number
+    of periods is increased, so the capture still contains whole periods.
+
+    Parameters
+    ----------
+    frequency : float
+        The frequency of the captured signal.
+
+    sample_rate : float
+        The sample rate of the scope.
+
+    periods : float
+        The minimal number of periods to capture.
+
+    min_samples : int
+        The minimal number of samples.
+
+    max_samples : int
+        The maximal number of samples.
+
+
+    Returns
+    -------
+    int
+        The number of samples to capture.
+
+
+    Example
+    -------
+    scope.nsamples = acquisition_length(1e6, scope.sample_rate)
+    """
+    samples_per_period = sample_rate / frequency
+    periods = max(periods, math.ceil(min_samples / samples_per_period))
+    n = int(round(periods * samples_per_period))
+    return int(min(max(n, min_samples, 2), max_samples))
+
+
+async def iq_measurements_async(source, scope, f, amplitude, metrics=None):
+    """Measures the time dependent signals of the DUT with asynchronous
+    drivers (see open_async_device). While this sweep waits for an
+    instrument, other sweeps in the same event loop can run.
+
+    Parameters
+    ----------
+    source : object
+        The asynchronous Signal Generator used for the experiment.
+
+    scope : object
+        The asynchronous Scope used for the experiment.
+
+    f : list
+        A list containing the frequencies at which to measure.
+
+    amplitude : float
+        The Amplitude with which the entire measurement will be done.
+
+    metrics : object
+        A SweepMetrics recording the stages "settle", "acquisition" and
+        "demodulation". The durations include the time other sweeps in the
+        event loop ran while this one waited.
+
+
+    Returns
+    -------
+    list
+        A list containing 4 numpy array I1, Q1, I2, Q2
+
+
+    Example
+    -------
+    f = np.logspace(3, 6, 31)\n
+    I1, Q1, I2, Q2 = asyncio.run(iq_measurements_async(source=source,
+    scope=scope, f=f, amplitude=1.0))
+    """
+    if metrics is None:
+        metrics = _NULL_METRICS
+
+    await source.set_amplitude(amplitude)
+
+    iq = np.zeros((4, len(f)))
+    h = None
+    for index, frequency in enumerate(f):
+        with metrics.stage("settle"):
+            await source.set_frequency(frequency)
+        with metrics.stage("acquisition") as record:
+            t, c1, c2 = await scope.waveforms()
+            record["samples"] = len(t)
+        with metrics.stage("demodulation", samples=len(t)):
+            if h is None or len(h) != len(t):
+                h = np.hanning(len(t))
+            iq[:, index] = iq_demodulation(t, c1, c2, frequency, h)
+
+    return [iq[0], iq[1], iq[2], iq[3]]
+
+
+def iq_measurements_pipelined(source, scope, f, amplitude, buffers=2,
+                              metrics=None):
+    """Measures the time dependent signals of the DUT like iq_measurements,
+    but the acquisition runs in a separate thread. While the capture of one
+    frequency is demodulated, the scope already measures the next one. The
+    captures are passed through a queue which holds at most `buffers`
+    waveforms.
+
+    Parameters
+    ----------
+    source : object
+        The Signal Generator used for the experiment.
+
+    scope : object
+        The Scope used for the experiment.
+
+    f : list
+        A list containing the frequencies at which to measure.
+
+    amplitude : float
+        The Amplitude with which the entire measurement will be done.
+
+    buffers : int
+        The maximal number of captured waveforms waiting for demodulation.
+
+    metrics : object
+        A SweepMetrics recording the stages "settle", "acquisition" and
+        "demodulation". The first two are recorded (and passed to the hook)
+        in the acquisition thread. If the summed durations of acquisition
+        and demodulation are larger than the sweep took, they overlapped.
+
+
+    Returns
+    -------
+    list
+        A list containing 4 numpy array I1, Q1, I2, Q2
+
+
+    Example
+    -------
+    f = np.logspace(3, 6, 31)\n
+    metrics = SweepMetrics()\n
+    I1, Q1, I2, Q2 = iq_measurements_pipelined(source=source, scope=scope,
+    f=f, amplitude=1.0, metrics=metrics)
+    """
+    if buffers < 1:
+        raise ValueError("at least one buffer is needed")
+    if metrics is None:
+        metrics = _NULL_METRICS
+
+    captures = queue.Queue(maxsize=buffers)
+    stop = threading.Event()
+
+    def acquire():
+        try:
+            source.amplitude = amplitude
+            for frequency in f:
+                if stop.is_set():
+                    return
+                print("Measuring at frequency = ", frequency)
+                with metrics.stage("settle"):
+                    source.frequency = frequency
+                with metrics.stage("acquisition") as record:
+                    capture = scope.waveforms()
+                    record["samples"] = len(capture[0])
+                captures.put((frequency, capture))
+        except Exception as error:
+            captures.put((None, error))
+
+    acquisition_thread = threading.Thread(target=acquire, daemon=True)
+    acquisition_thread.start()
+
+    # demodulates the captures in the order they were measured
+    iq = np.zeros((4, len(f)))
+    h = None
+    try:
+        for index in range(len(f)):
+            frequency, capture = captures.get()
+            if frequency is None:
+                raise capture
+            t, c1, c2 = capture
+            with metrics.stage("demodulation", samples=len(t)):
+                if h is None or len(h) != len(t):
+                    h = np.hanning(len(t))
+                iq[:, index] = iq_demodulation(t, c1, c2, frequency, h)
+    finally:
+        # unblocks the acquisition thread if the demodulation failed
+        stop.set()
+        while acquisition_thread.is_alive():
+            try:
+                captures.get(timeout=0.01)
+            except queue.Empty:
+                pass
+
+    return [iq[0], iq[1], iq[2], iq[3]]
+
+
+def iq_measurements_multisine(source, scope, f, amplitude, ncaptures=1,
+                              metrics=None):
+    """Measures the time dependent signals of the DUT with a multisine. The
+    frequencies are split into ncaptures groups, the source emits all tones
+    of a group at once and each capture is demodulated at all of its tones.
+    Afterwards the source is switched back to its previous single tone.
+    The tones of one capture have to be separated by several frequency bins
+    (sample_rate / nsamples) of the scope, otherwise they leak into each
+    other. Because every tone gets its own phase, I/Q contain this phase as
+    well, the results of frequency_response are not affected by it.
+
+    Parameters
+    ----------
+    source : object
+        The Signal Generator used for the experiment. It has to support
+        multiple tones.
+
+    scope : object
+        The Scope used for the experiment.
+
+    f : list
+        A list containing the frequencies at which to measure.
+
+    amplitude : float
+        The Amplitude of every tone.
+
+    ncaptures : int
+        The number of captures used for the whole sweep. The frequency f[i]
+        is measured in the capture i % ncaptures.
+
+    metrics : object
+        A SweepMetrics recording the stages "settle", "acquisition" and
+        "demodulation", once per capture.
+
+
+    Returns
+    -------
+    list
+        A list containing 4 numpy array I1, Q1, I2, Q2
+
+
+    Example
+    -------
+    f = np.logspace(3, 6, 31)\n
+    I1, Q1, I2, Q2 = iq_measurements_multisine(source=source, scope=scope,
+    f=f, amplitude=1.0)
+    """
+    f = np.asarray(f, dtype=float)
+    if ncaptures < 1:
+        raise ValueError("ncaptures has to be at least 1")
+    if metrics is None:
+        metrics = _NULL_METRICS
+
+    # setting the source amplitude
+    source.amplitude = amplitude
+
+    # initialise the arrays
+    iq = np.zeros((4, len(f)))
+    h = None
+    previous_frequency = source.frequency
+
+    try:
+        for capture in range(min(ncaptures, len(f))):
+            indices = np.arange(capture, len(f), ncaptures)
+            print("Measuring at", len(indices), "frequencies with one capture")
+
+            # sets all tones of this capture
+            with metrics.stage("settle", tones=len(indices)):
+                source.frequencies = f[indices]
+
+            n = scope.nsamples
+            with metrics.stage("acquisition", samples=n):
+                t, c1, c2 = scope.waveforms()
+
+            # demodulates the capture at every tone
+            with metrics.stage("demodulation", samples=n,
+                               tones=len(indices)):
+                if h is None or len(h) != n:
+                    h = np.hanning(n)
+                for index in indices:
+                    iq[:, index] = iq_demodulation(t, c1, c2, f[index], h)
+    finally:
+        # switches the source back to a single tone
+        source.frequency = previous_frequency
+
+    return [iq[0], iq[1], iq[2], iq[3]]
+
+
+def adaptive_iq_measurements(source, scope, f, amplitude, max_points=100,
+                             amplitude_tol=0.02, phase_tol=0.02):
+    """Measures the time dependent signals of the DUT on an adaptive
+    frequency grid. The sweep starts with the coarse grid f and adds the
+    geometric mean of two neighbouring frequencies wherever the amplitude
+    or the phase of the frequency response changes more than the tolerance
+    between them. This is repeated until all neighbours are within the
+    tolerances or max_points frequencies are measured.
+
+    Parameters
+    ----------
+    source : object
+        The Signal Generator used for the experiment.
+
+    scope : object
+        The Scope used for the experiment.
+
+    f : list
+        A list containing the frequencies of the coarse grid (> 0).
+
+    amplitude : float
+        The Amplitude with which the entire measurement will be done.
+
+    max_points : int
+        The maximal number of measured frequencies.
+
+    amplitude_tol : float
+        The maximal change of ln(A) between two neighbouring frequencies.
+
+    phase_tol : float
+        The maximal change of the phase (in rad) between two neighbouring
+        frequencies.
+
+
+    Returns
+    -------
+    list
+        A list containing 5 numpy array f, I1, Q1, I2, Q2 sorted by the
+        frequency.
+
+
+    Example
+    -------
+    f = np.logspace(3, 6, 7)\n
+    f, I1, Q1, I2, Q2 = adaptive_iq_measurements(source=source, scope=scope,
+    f=f, amplitude=1.0, max_points=40)
+    """
+    f = np.unique(np.asarray(f, dtype=float))
+    if len(f) < 2 or f[0] <= 0:
+        raise ValueError("at least two positive frequencies are needed")
+    iq = np.array(iq_measurements(source, scope, f, amplitude))
+
+    while len(f) < max_points:
+        a, phi = frequency_response(*iq, unwrap=True)
+
+        # changes between all neighbours relative to the tolerances
+        error = np.maximum(np.abs(np.diff(np.log(a))) / amplitude_tol,
+                           np.abs(np.diff(phi)) / phase_tol)
+
+        # intervals which can't be split anymore are skipped
+        error[f[1:] / f[:-1] < 1 + 1e-9] = 0
+        intervals = np.flatnonzero(error > 1)
+        if len(intervals) == 0:
+            break
+
+        # the worst intervals are refined first
+        intervals = intervals[np.argsort(-error[intervals], kind="stable")]
+        intervals = intervals[:max_points - len(f)]
+        new_f = np.sqrt(f[intervals] * f[intervals + 1])
+        new_iq = np.array(iq_measurements(source, scope, new_f, amplitude))
+
+        f = np.concatenate([f, new_f])
+        iq = np.concatenate([iq, new_iq], axis=1)
+        order = np.argsort(f)
+        f = f[order]
+        iq = iq[:, order]
+
+    return [f, iq[0], iq[1], iq[2], iq[3]]
+
+
+def iq_demodulation(t, c1, c2, frequency, h=None):
+    """Calculates the I/Q values of two captured channels at a single
+    frequency. The sums are done as dot products of the windowed channels
+    with a complex phasor, whose real part is the cosine and whose imaginary
+    part is the negative sine.
+
+    Parameters
+    ----------
+    t : object
+        1D numpy array with the sample times of the capture.
+
+    c1 : object
+        1D numpy array with the samples of channel 1.
+
+    c2 : object
+        1D numpy array with the samples of channel 2.
+
+    frequency : float
+        The frequency at which to demodulate.
+
+    h : object
+        The window used for the demodulation. If None a hanning window with
+        the length of t is used.
+
+
+    Returns
+    -------
+    list
+        A list containing the 4 floats I1, Q1, I2, Q2
+
+
+    Example
+    -------
+    t, c1, c2 = scope.waveforms()\n
+    I1, Q1, I2, Q2 = iq_demodulation(t, c1, c2, frequency=1e3)
+    """
+    if h is None:
+        h = np.hanning(len(t))
+
+    # windowed phasor cos(2*pi*f*t) + j*sin(-2*pi*f*t)
+    phasor = h * np.exp(-2j * np.pi * frequency * np.asarray(t))
+
+    # normalised with the sum of the window (n - 1) / 2 for a hanning
+    # window, so captures of any length give the same amplitude
+    z1 = (2 / np.sum(h)) * np.dot(c1, phasor)
+    z2 = (2 / np.sum(h)) * np.dot(c2, phasor)
+    return [z1.real, z1.imag, z2.real, z2.imag]
+
+
+def demodulate_captures(t, c1, c2, f, processes=None, chunk_size=None):
+    """Calculates the I/Q values of many stored captures with a pool of
+    processes. The captures are put into shared memory once, every worker
+    demodulates a slice of the captures on views of this memory, so the
+    waveforms are never pickled.
+
+    Parameters
+    ----------
+    t : object
+        1D numpy array with the sample times of all captures or a 2D numpy
+        array with one row per capture.
+
+    c1 : object
+        2D numpy array with the samples of channel 1, one row per capture.
+
+    c2 : object
+        2D numpy array with the samples of channel 2, one row per capture.
+
+    f : list
+        The frequency at which every capture is demodulated.
+
+    processes : int
+        The number of worker processes, None uses one per core and 1
+        demodulates in the calling process.
+
+    chunk_size : int
+        The number of captures demodulated per task.
+
+
+    Returns
+    -------
+    list
+        A list containing 4 numpy array I1, Q1, I2, Q2 in the order of f
+
+
+    Example
+    -------
+    I1, Q1, I2, Q2 = demodulate_captures(t, c1, c2, f, processes=4)
+    """
+    f = np.asarray(f, dtype=float)
+    c1 = np.atleast_2d(np.asarray(c1, dtype=float))
+    c2 = np.atleast_2d(np.asarray(c2, dtype=float))
+    t = np.asarray(t, dtype=float)
+    if c1.shape != c2.shape or len(c1) != len(f) \
+            or t.shape[-1] != c1.shape[1]:
+        raise ValueError("the captures and frequencies do not match")
+
+    if len(f) == 0:
+        return [np.array([]) for _ in range(4)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(len(f) / (4 * processes)))
+    slices = [(start, min(start + chunk_size, len(f)))
+              for start in range(0, len(f), chunk_size)]
+
+    if processes == 1 or len(slices) <= 1:
+        return list(_demodulate_slice(0, len(f), {"t": t, "c1": c1,
+                                                  "c2": c2, "f": f}))
+
+    # copies all inputs into shared memory once
+    blocks = []
+    descriptions = {}
+    try:
+        for name, array in (("t", t), ("c1", c1), ("c2", c2), ("f", f)):
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype,
+                       buffer=block.buf)[...] = array
+            descriptions[name] = (block.name, array.shape, array.dtype.str)
+
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_attach_shared_captures,
+                                 initargs=(descriptions,)) as executor:
+            results = list(executor.map(_demodulate_shared_slice,
+                                        *zip(*slices)))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return list(np.hstack(results))
+
+
+# views of the shared captures inside a worker process of demodulate_captures
+_shared_captures = {}
+
+
+def _attach_shared_captures(descriptions):
+    """Helper function attaches a worker process to the shared captures."""
+    for name, (block_name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_captures[name] = np.ndarray(shape, dtype=dtype,
+                                            buffer=block.buf)
+        # keeps the block open as long as the view is used
+        _shared_captures["_" + name] = block
+
+
+def _demodulate_shared_slice(start, stop):
+    """Helper function demodulates a slice of the shared captures."""
+    return _demodulate_slice(start, stop, _shared_captures)
+
+
+def _demodulate_slice(start, stop, arrays):
+    """Helper function demodulates the captures start to stop."""
+    t = arrays["t"]
+    iq = np.zeros((4, stop - start))
+    h = None
+    for index in range(start, stop):
+        t_capture = t if t.ndim == 1 else t[index]
+        if h is None or len(h) != len(t_capture):
+            h = np.hanning(len(t_capture))
+        iq[:, index - start] = iq_demodulation(
+            t_capture, arrays["c1"][index], arrays["c2"][index],
+            arrays["f"][index], h)
+    return iq
+
+
+def frequency_response(i1, q1, i2, q2, unwrap=False):
+    """Calculates the frequency response with the measurements gathered in
+    the function iq_measurements. These two arrays can be plotted as
+    the Bode plot. The inputs can also be 2D numpy arrays with one sweep
+    per row, in which case all sweeps are calculated at once.
+
+    Parameters
+    ----------
+    i1 : list
+        I1 of the I/Q Values
+
+    q1 : list
+        Q1 of the I/Q Values
+
+    i2 : list
+        I2 of the I/Q Values
+
+    q2 : list
+        Q2 of the I/Q Values
+
+    unwrap : bool
+        If True the phase is unwrapped along the frequency axis (the last
+        axis), so it can directly be used for the group delay.
+
+
+    Returns
+    -------
+    list
+        A list containing two numpy array A & Phi:
+        A is a numpy array containing the amplitude at different
+        frequencies. Phi is a numpy array containing the phase at different
+        frequencies. Both have the shape of the inputs.
+
+
+    Example
+    -------
+    A, Phi = frequency_response(I1, Q1, I2, Q2)
+    """
+    i1, q1, i2, q2 = np.broadcast_arrays(np.asarray(i1, dtype=float),
+                                         np.asarray(q1, dtype=float),
+                                         np.asarray(i2, dtype=float),
+                                         np.asarray(q2, dtype=float))
+
+    a = np.hypot(i2, q2) / np.hypot(i1, q1)
+    phi = np.arctan2(q2, i2) - np.arctan2(q1, i1)
+    if unwrap:
+        phi = np.unwrap(phi, axis=-1)
+    return [a, phi]
+
+
+def iter_frequency_response(records):
+    """Calculates the frequency response of every record yielded by
+    iter_iq_measurements as soon as it arrives.
+
+    Parameters
+    ----------
+    records : object
+        An iterable of (f, I1, Q1, I2, Q2) tuples. Further values, e.g. the
+        standard errors of averaged sweeps, are ignored.
+
+
+    Yields
+    ------
+    tuple
+        (f, A, Phi) of one frequency
+
+
+    Example
+    -------
+    for f, A, Phi in iter_frequency_response(iter_iq_measurements(
+    source=source, scope=scope, f=f, amplitude=1.0)):\n
+        print(f, A, Phi)
+    """
+    for record in records:
+        frequency, i1, q1, i2, q2 = record[:5]
+        a, phi = frequency_response(i1, q1, i2, q2)
+        yield frequency, float(a), float(phi)
+
+
+def tee_to_file(records, fname, labels=[], chunk_size=1):
+    """Appends the records of a streaming sweep to a file with save_data
+    and passes them on unchanged. This way a long sweep can be logged while
+    it is consumed, e.g. by a live plot.
+
+    Parameters
+    ----------
+    records : object
+        An iterable of tuples or lists with the same length.
+
+    fname : str
+        The file path where the records are appended.
+
+    labels : list
+        The headers written if the file is new or empty.
+
+    chunk_size : int
+        The number of records written at once.
+
+
+    Yields
+    ------
+    tuple
+        The records in the order they arrived.
+
+
+    Example
+    -------
+    records = tee_to_file(iter_iq_measurements(source=source, scope=scope,
+    f=f, amplitude=1.0), "iq_data.txt", labels=["f", "I1", "Q1", "I2", "Q2"])
+    """
+    chunk = []
+    try:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                save_data(fname, chunk, labels=labels, append=True)
+                chunk = []
+            yield record
+    finally:
+        # the rest is also written if the consumer stopped early
+        if len(chunk) > 0:
+            save_data(fname, chunk, labels=labels, append=True)
+
+
+def group_delay(f, phi, method="gradient"):
+    """Calculates the group delay of a given system
+
+        Parameters
+        ----------
+        f : list
+            contains a list or 1D numpy array of frequencies
+
+        phi : list
+            contains a list or numpy array of phase responses. A 2D numpy
+            array contains one phase response per row.
+
+        method : str
+            "gradient" uses second order finite differences on the (non
+            uniform) frequency grid, "spline" derives a cubic spline through
+            the phase response.
+
+        Returns
+        -------
+        list
+            a numpy array with the shape of phi containing the group_delay at
+            different frequencies.
+
+
+        Example
+        -------
+        f = np.logspace(3, 6, 31)\n
+        phi = -np.arctan(f*2*np.pi*3300*1.5e-9)\n
+        tau_g = group_delay(f, phi)
+        """
+    f = np.asarray(f, dtype=float)
+    phi = np.asarray(phi, dtype=float)
+    if len(f) < 2:
+        raise ValueError("at least two frequencies are needed")
+
+    if method == "gradient":
+        edge_order = 2 if len(f) > 2 else 1
+        d_phi = np.gradient(phi, f, axis=-1, edge_order=edge_order)
+    elif method == "spline":
+        d_phi = interpolate.CubicSpline(f, phi, axis=-1).derivative()(f)
+    else:
+        raise ValueError(f"unknown method {method!r}")
+    return -d_phi / (2 * np.pi)
+
+
+class SweepResult:
+    """Compact container for the results of a frequency sweep. All values
+    are stored in one contiguous 2D float numpy array with one row per
+    field (the same layout load_data and load_archive return), so the
+    fields are views without copies and the buffer can be saved directly.
+    A and phi are NaN until compute_response is called.
+
+    Parameters
+    ----------
+    n : int
+        The number of frequencies.
+
+
+    Example
+    -------
+    res = SweepResult.measure(source=source, scope=scope,
+    f=np.logspace(3, 6, 31), amplitude=1.0)\n
+    res.compute_response()\n
+    res.save("frequency_response.t2a")
+    """
+
+    __slots__ = ("_data",)
+
+    FIELDS = ("f", "I1", "Q1", "I2", "Q2", "A", "phi")
+
+    def __init__(self, n):
+        self._data = np.full((len(self.FIELDS), int(n)), np.nan)
+
+    @classmethod
+    def from_iq(cls, f, i1, q1, i2, q2):
+        """Creates the result from the arrays returned by iq_measurements."""
+        result = cls(len(f))
+        for row, values in enumerate((f, i1, q1, i2, q2)):
+            result._data[row] = values
+        return result
+
+    @classmethod
+    def measure(cls, source, scope, f, amplitude, **kwargs):
+        """Measures a sweep with iter_iq_measurements directly into the
+        buffer, the keyword arguments are passed on."""
+        result = cls(len(f))
+        for index, record in enumerate(iter_iq_measurements(
+                source, scope, f, amplitude, **kwargs)):
+            result._data[:5, index] = record[:5]
+        return result
+
+    @classmethod
+    def load(cls, fname):
+        """Loads a result saved with save, missing fields stay NaN."""
+        data, labels = load_data(fname, col_labels=True)
+        labels = [label.strip() for label in labels]
+        result = cls(data.shape[-1])
+        for row, name in enumerate(cls.FIELDS):
+            if name in labels:
+                result._data[row] = data[labels.index(name)]
+        return result
+
+    @property
+    def data(self):
+        """The buffer with one row per field."""
+        return self._data
+
+    def __len__(self):
+        return self._data.shape[1]
+
+    def __getitem__(self, name):
+        return self._data[self.FIELDS.index(name)]
+
+    @property
+    def f(self):
+        return self._data[0]
+
+    @property
+    def i1(self):
+        return self._data[1]
+
+    @property
+    def q1(self):
+        return self._data[2]
+
+    @property
+    def i2(self):
+        return self._data[3]
+
+    @property
+    def q2(self):
+        return self._data[4]
+
+    @property
+    def a(self):
+        return self._data[5]
+
+    @property
+    def phi(self):
+        return self._data[6]
+
+    def compute_response(self, unwrap=False):
+        """Fills A and phi in place, like frequency_response. With
+        unwrap=True np.unwrap needs one temporary array for phi."""
+        f, i1, q1, i2, q2, a, phi = self._data
+        np.hypot(i2, q2, out=a)
+        a /= np.hypot(i1, q1)
+        np.arctan2(q2, i2, out=phi)
+        phi -= np.arctan2(q1, i1)
+        if unwrap:
+            phi[...] = np.unwrap(phi)
+        return self
+
+    def save(self, fname, **kwargs):
+        """Saves all fields with their names as labels. Archives (see
+        ARCHIVE_EXTENSION) get the buffer written as it is. Other files are
+        a formatted text export written with save_data, by default with
+        fmt="%.17g", so load reads the same values back."""
+        if fname.endswith(ARCHIVE_EXTENSION):
+            save_archive(fname, self._data, labels=self.FIELDS, **kwargs)
+        else:
+            kwargs.setdefault("fmt", "%.17g")
+            save_data(fname, *self._data, labels=self.FIELDS, **kwargs)
+
+    def __repr__(self):
+        return f"SweepResult(n={len(self)})"
+
+
+class MeasurementCache:
+    """Persistent cache for measured points. Every point is stored in its
+    own file in directory, keyed by the fingerprint of the setup, the
+    stimulus (frequency or source voltage) and the acquisition settings.
+    When the cache grows larger than max_bytes, the least recently used
+    points are deleted. The order of use is read from the directory once
+    and then kept in memory, points written by other caches afterwards are
+    only seen when they are read.
+
+    Parameters
+    ----------
+    directory : str
+        The directory where the points are stored.
+
+    fingerprint : str
+        Identifies the setup, e.g. the device addresses and the DUT. Points
+        of other fingerprints are never returned.
+
+    max_bytes : int
+        The maximal size of all points in the directory.
+
+
+    Example
+    -------
+    cache = MeasurementCache("cache", fingerprint="0xC34F 0xDC31 RC 1")\n
+    I1, Q1, I2, Q2 = iq_measurements(source=source, scope=scope, f=f,
+    amplitude=1.0, cache=cache)
+    """
+
+    def __init__(self, directory, fingerprint, max_bytes=100 * 2 ** 20):
+        self._directory = directory
+        self._fingerprint = str(fingerprint)
+        self._max_bytes = int(max_bytes)
+        self._fingerprint_directory = os.path.join(
+            directory, self._hash(self._fingerprint))
+        os.makedirs(self._fingerprint_directory, exist_ok=True)
+
+        # size of every point (of all fingerprints), least recently used first
+        self._index = OrderedDict(
+            (path, size) for path, _, size in
+            sorted(self._entries(), key=lambda entry: entry[1]))
+        self._size = sum(self._index.values())
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    @property
+    def size(self):
+        """The size of all points in the directory in bytes."""
+        return self._size
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+    @classmethod
+    def _plain(cls, value):
+        """Helper function converts numpy values in the settings to python
+        types, so they can be saved as json."""
+        if isinstance(value, dict):
+            return {key: cls._plain(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls._plain(item) for item in value]
+        if isinstance(value, (np.generic, np.ndarray)):
+            return value.tolist()
+        return value
+
+    def _path(self, stimulus, settings):
+        key = json.dumps([float(stimulus).hex(), self._plain(settings)],
+                         sort_keys=True)
+        return os.path.join(self._fingerprint_directory,
+                            self._hash(key) + ".npy")
+
+    def _entries(self):
+        """Helper function lists the path, last use and size of all points
+        in the directory (of all fingerprints)."""
+        entries = []
+        for root, _, files in os.walk(self._directory):
+            for name in files:
+                if name.endswith(".npy"):
+                    status = os.stat(os.path.join(root, name))
+                    entries.append((os.path.join(root, name),
+                                    status.st_mtime_ns, status.st_size))
+        return entries
+
+    def get(self, stimulus, settings=None):
+        """Returns the cached point as numpy array or None."""
+        path = self._path(stimulus, settings)
+        try:
+            value = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        self._touch(path)
+        if path not in self._index:
+            # written by another cache on the same directory
+            self._index[path] = os.path.getsize(path)
+            self._size += self._index[path]
+        self._index.move_to_end(path)
+        return value
+
+    @staticmethod
+    def _touch(path):
+        """Helper function marks a point as recently used. The time is set
+        explicitly, the file system clock can be too coarse for the LRU."""
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def put(self, stimulus, value, settings=None):
+        """Stores a measured point and evicts old points if necessary."""
+        path = self._path(stimulus, settings)
+        self._size -= self._index.pop(path, 0)
+        np.save(path, np.asarray(value, dtype=float))
+        self._touch(path)
+        self._index[path] = os.path.getsize(path)
+        self._size += self._index[path]
+        if self._size > self._max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Helper function deletes the least recently used points until the
+        cache is smaller than max_bytes."""
+        while self._size > self._max_bytes and len(self._index) > 0:
+            path, size = self._index.popitem(last=False)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            self._size -= size
+
+    def invalidate(self, stimulus=None, settings=None):
+        """Deletes one point or, if stimulus is None, all points of this
+        fingerprint, e.g. after the DUT was changed."""
+        if stimulus is not None:
+            paths = [self._path(stimulus, settings)]
+        else:
+            paths = [os.path.join(self._fingerprint_directory, name)
+                     for name in os.listdir(self._fingerprint_directory)]
+        for path in paths:
+            self._size -= self._index.pop(path, 0)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def save_data(fname, *args, labels=[], append=False, chunk_size=10000,
+              metadata=None, metrics=None, fmt="%.6f"):
+    """Saves a unspecified number of measurements and saves them into a file.
+    The rows are formatted in chunks and written through a buffered file,
+    so also large measurements can be saved quickly. If fname ends with
+    ARCHIVE_EXTENSION a binary archive is written instead (see
+    save_archive).
+
+            Parameters
+            ----------
+            fname : str
+                the file path where the file will be saved
+
+            *args : list
+                a list or 1D / 2D numpy array with measurements with
+                the same length
+
+            labels : list
+                a list of strings which will be the headers for the columns
+
+            append : bool
+                if True the rows are appended to the file. The labels are
+                only written if the file is new or empty. This allows to
+                log the measurements incrementally during a sweep.
+
+            chunk_size : int
+                the number of rows formatted at once
+
+            metadata : dict
+                JSON serialisable information about the sweep. Text files
+                store it in a comment line after the labels, which is only
+                written when the file is started (see read_metadata).
+
+            metrics : object
+                a SweepMetrics recording the stage "write" with the number
+                of rows and bytes
+
+            fmt : str
+                the format of the numbers in text files, "%.17g" saves them
+                without losing precision
+
+            Example
+            -------
+            save_data("iq_data.txt", f, I1, Q1, I2, Q2) # f¨unf 1D Arrays
+            """
+    if len(args) == 0:
+        raise ValueError("no measurements to save")
+
+    # every measurement becomes one or more columns of the table
+    columns = []
+    for measurement in args:
+        measurement = np.asarray(measurement, dtype=float)
+        if measurement.ndim > 1:
+            # the width is given explicitly, so empty measurements work
+            columns.append(measurement.reshape(
+                len(measurement), int(np.prod(measurement.shape[1:]))))
+        else:
+            columns.append(measurement[:, None])
+    if any(len(column) != len(columns[0]) for column in columns):
+        raise ValueError("all measurements need the same length")
+    table = np.hstack(columns)
+    if metrics is None:
+        metrics = _NULL_METRICS
+
+    if fname.endswith(ARCHIVE_EXTENSION):
+        if append:
+            raise ValueError("archives can not be appended")
+        with metrics.stage("write", rows=len(table)) as record:
+            save_archive(fname, table.T, labels=labels, metadata=metadata)
+            record["bytes"] = os.path.getsize(fname)
+        return
+
+    new_file = not (append and os.path.exists(fname)
+                    and os.path.getsize(fname) > 0)
+
+    # Formatting the numbers, by default to 6 digits after the comma
+    row_format = ",".join([fmt] * table.shape[1]) + "\n"
+
+    with metrics.stage("write", rows=len(table)) as record, \
+            open(fname, "a" if append else "w", buffering=1 << 20) as f:
+        start_position = f.tell()
+        if new_file and len(labels) > 0:
+            f.write("# " + "".join(str(header) + "," for header in labels)
+                    + "\n")
+        if new_file and metadata is not None:
+            f.write(_METADATA_PREFIX + json.dumps(metadata) + "\n")
+        for start in range(0, len(table), chunk_size):
+            chunk = table[start:start + chunk_size]
+            f.write((row_format * len(chunk)) % tuple(chunk.ravel()))
+        record["bytes"] = f.tell() - start_position
+
+
+def load_data(fname, col_labels=False, structured=False, chunk_size=100000,
+              metrics=None):
+    """Loads the measurement data from the specified file. Files ending with
+    ARCHIVE_EXTENSION are memory mapped with load_archive instead of being
+    parsed.
+
+        Parameters
+        ----------
+        fname : str
+            the file path where the file is saved
+
+        *col_labels : bool
+            specifies if the file contains a Header string
+
+        structured : bool
+            if True a structured numpy array with one named field per
+            column is returned. The names are taken from the Header string.
+
+        chunk_size : int
+            the number of lines parsed at once
+
+        metrics : object
+            a SweepMetrics recording the stage "read" with the number of
+            rows and bytes
+
+        Returns
+        -------
+         list
+            when col_labels = False a 2D float numpy array with one row per
+            column of the file.
+            when col_label = True a 2D float numpy array and a list with the
+            headers as string.
+            when structured = True a structured numpy array.
+
+        Example
         -------
         f, A, phi = load_data("frequency_response.txt")
         """
-    f = open(fname, "r")
-    text_file_as_string = f.read()
-    lines_in_file = text_file_as_string.split("\n")
+    if metrics is None:
+        metrics = _NULL_METRICS
+    with metrics.stage("read", bytes=os.path.getsize(fname)) as record:
+        loaded = _read_data(fname, col_labels, structured, chunk_size)
+        record["rows"] = len(loaded) if structured else \
+            (loaded[0] if col_labels else loaded).shape[-1]
+    return loaded
 
-    parsed_file = []
 
-    for element in lines_in_file[0].split(","):
-        parsed_file.append([])
+def read_metadata(fname):
+    """Reads the metadata saved with save_data without loading the data.
 
-    header_string = ""
-    if col_labels:
-        header_string = lines_in_file[0]
-        if header_string[-1] == ",":
-            header_string = header_string[:-1]
-        if "#" not in header_string:
+        Parameters
+        ----------
+        fname : str
+            the file path of a text file or an archive
+
+        Returns
+        -------
+         dict
+            the metadata or None if the file has none.
+
+        Example
+        -------
+        metadata = read_metadata("iq_data.txt")
+        """
+    if fname.endswith(ARCHIVE_EXTENSION):
+        return read_archive_header(fname)["metadata"] or None
+    with open(fname, "r") as f:
+        # the metadata follows the labels before the first row
+        for line in f:
+            if line.startswith(_METADATA_PREFIX):
+                return json.loads(line[len(_METADATA_PREFIX):])
+            if not line.startswith("#"):
+                break
+    return None
+
+
+def _read_data(fname, col_labels, structured, chunk_size):
+    """Helper function reads the file for load_data."""
+    if fname.endswith(ARCHIVE_EXTENSION):
+        measurement_array, header = load_archive(fname)
+        header_string = header["labels"]
+        if (col_labels or structured) and len(header_string) == 0:
             raise ValueError("no labels present in the file")
-        if not len(lines_in_file[1].split(",")) == len(
-                header_string.split(",")):
-            raise ValueError("invalid number of labels")
-        header_string = header_string.replace("#", "")
-        header_string = header_string[1:]
-        header_string = header_string.split(",")
-        lines_in_file = lines_in_file[1:]
-
-    for line in lines_in_file:
-        elements = line.split(",")
-        if len(line) > 0 and not line[0] == "#":
-            for i in range(len(elements)):
-                try:
-                    parsed_file[i].append(float(elements[i]))
-                except ValueError:
-                    print("Parsing Error--------")
-                    print("Could not parse : ", elements[i])
-                    print("--------")
-
-    measurement_array = []
-
-    for measurement in parsed_file:
-        measurement_array.append(np.array(measurement))
+        return _format_loaded_data(measurement_array, header_string,
+                                   col_labels, structured)
 
+    header_string = ""
+    chunks = []
+    n_columns = None
+
+    with open(fname, "r") as f:
+        if col_labels or structured:
+            header_string = f.readline().rstrip("\n")
+            if header_string[-1:] == ",":
+                header_string = header_string[:-1]
+            if "#" not in header_string:
+                raise ValueError("no labels present in the file")
+            header_string = header_string.replace("#", "")
+            header_string = header_string[1:]
+            header_string = header_string.split(",")
+
+        # the line numbers are only kept for the error messages
+        first_line = 2 if (col_labels or structured) else 1
+        lines = []
+        line_numbers = []
+        for line_number, line in enumerate(f, first_line):
+            line = line.strip()
+            if len(line) > 0 and not line[0] == "#":
+                lines.append(line)
+                line_numbers.append(line_number)
+            if len(lines) == chunk_size:
+                chunks.append(_parse_lines(lines, line_numbers, n_columns))
+                n_columns = chunks[-1].shape[1]
+                lines = []
+                line_numbers = []
+        if len(lines) > 0:
+            chunks.append(_parse_lines(lines, line_numbers, n_columns))
+
+    if len(chunks) == 0:
+        measurement_array = np.zeros((0, 0))
+    else:
+        # one contiguous row per column of the file
+        measurement_array = np.ascontiguousarray(np.vstack(chunks).T)
+
+    if (col_labels or structured) and len(chunks) > 0 \
+            and not len(measurement_array) == len(header_string):
+        raise ValueError("invalid number of labels")
+
+    return _format_loaded_data(measurement_array, header_string, col_labels,
+                               structured)
+
+
+def _format_loaded_data(measurement_array, header_string, col_labels,
+                        structured):
+    """Helper function returns the loaded data in the form requested from
+    load_data."""
+    if structured:
+        names = [header.strip() for header in header_string]
+        structured_array = np.empty(measurement_array.shape[1:],
+                                    dtype=[(name, float) for name in names])
+        for name, column in zip(names, measurement_array):
+            structured_array[name] = column
+        return structured_array
     if col_labels:
-        return [np.array(measurement_array, dtype=object), header_string]
+        return [measurement_array, header_string]
     else:
-        return np.array(measurement_array, dtype=object)
+        return measurement_array
+
+
+def _parse_lines(lines, line_numbers, n_columns=None):
+    """Helper function parses comma separated lines into a 2D float numpy
+    array. The line numbers are only used for the error messages."""
+    rows = [line.split(",") for line in lines]
+    try:
+        table = np.array(rows, dtype=float)
+    except ValueError:
+        table = None
+
+    if table is not None and table.ndim == 2 \
+            and (n_columns is None or table.shape[1] == n_columns):
+        return table
+
+    # finds the line which could not be parsed
+    if n_columns is None:
+        n_columns = len(rows[0])
+    for line_number, row in zip(line_numbers, rows):
+        if len(row) != n_columns:
+            raise ValueError(f"line {line_number}: expected {n_columns} "
+                             f"values, found {len(row)}")
+        for element in row:
+            try:
+                float(element)
+            except ValueError:
+                raise ValueError(f"line {line_number}: could not parse "
+                                 f"{element!r}") from None
+    raise ValueError(f"line {line_numbers[0]}: could not parse the file")
+
+
+def save_archive(fname, data, labels=[], metadata=None):
+    """Saves measurements into a binary archive. The archive starts with a
+    small JSON header containing the labels, dtype, shape and metadata,
+    followed by the raw data with one contiguous block per column. This way
+    every column can be read without touching the others.
+
+        Parameters
+        ----------
+        fname : str
+            the file path where the archive will be saved
+
+        data : object
+            a 2D numpy array with one row per column (measurement)
+
+        labels : list
+            a list of strings which will be the headers for the columns
+
+        metadata : dict
+            JSON serialisable information about the sweep
+
+        Example
+        -------
+        save_archive("iq_data.t2a", np.array([f, I1, Q1, I2, Q2]),
+        labels=["f", "I1", "Q1", "I2", "Q2"], metadata={"amplitude": 1.0})
+        """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    if data.ndim != 2:
+        raise ValueError("data has to be a 2D array")
+    if len(labels) > 0 and len(labels) != len(data):
+        raise ValueError("invalid number of labels")
+
+    header = {"labels": [str(label) for label in labels],
+              "dtype": data.dtype.newbyteorder("<").str,
+              "shape": list(data.shape),
+              "metadata": {} if metadata is None else metadata}
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    # the data starts aligned after the magic, the header length and header
+    offset = len(_ARCHIVE_MAGIC) + 8 + len(header_bytes)
+    padding = -offset % _ARCHIVE_ALIGNMENT
+
+    with open(fname, "wb") as f:
+        f.write(_ARCHIVE_MAGIC)
+        f.write((len(header_bytes) + padding).to_bytes(8, "little"))
+        f.write(header_bytes + b" " * padding)
+        for column in data:
+            np.ascontiguousarray(column, dtype=header["dtype"]).tofile(f)
+
+
+def read_archive_header(fname):
+    """Reads the header of a binary archive written by save_archive. The
+    returned dict contains the keys "labels", "dtype", "shape", "metadata"
+    and "offset" (the position of the data in the file)."""
+    with open(fname, "rb") as f:
+        if f.read(len(_ARCHIVE_MAGIC)) != _ARCHIVE_MAGIC:
+            raise ValueError(f"{fname} is not a measurement archive")
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    header["offset"] = len(_ARCHIVE_MAGIC) + 8 + header_length
+    return header
+
+
+def load_archive(fname):
+    """Opens a binary archive written by save_archive without reading the
+    data. The data is memory mapped, so only the columns which are accessed
+    are read from the disk.
+
+        Parameters
+        ----------
+        fname : str
+            the file path where the archive is saved
+
+        Returns
+        -------
+        list
+            a read only 2D numpy array (memory map) with one row per column
+            and the header of the archive as dict.
+
+        Example
+        -------
+        data, header = load_archive("iq_data.t2a")\n
+        f = data[header["labels"].index("f")]
+        """
+    header = read_archive_header(fname)
+    shape = tuple(header["shape"])
+    if np.prod(shape) == 0:
+        return [np.zeros(shape, dtype=header["dtype"]), header]
+    data = np.memmap(fname, dtype=header["dtype"], mode="r",
+                     offset=header["offset"], shape=shape)
+    return [data, header]
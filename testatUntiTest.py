@@ -1,9 +1,25 @@
+import asyncio
+import os
+import tempfile
+import time
 import unittest
 import numpy as np
 from matplotlib import pyplot as plt
-from dateien.devices import open_device
+from dateien.devices import open_device, VoltageSource, Diode, VoltMeter, \
+    AmpereMeter, SineSource, Oscilloscope, Filter, register_device, \
+    unregister_device, open_async_device, AsyncSineSource, AsyncOscilloscope
 from testat2 import vi_characteristic, is_strictly_monotonic, interpolation, \
-    linear_interpolation_x_axis, linear_interpolation_y_axis
+    linear_interpolation_x_axis, linear_interpolation_y_axis, \
+    iq_demodulation, iq_measurements, iq_measurements_multisine, \
+    frequency_response, \
+    iq_measurements_pipelined, group_delay, VICurve, save_data, load_data, \
+    load_archive, adaptive_iq_measurements, adaptive_vi_characteristic, \
+    acquisition_length, demodulate_captures, run_stations, \
+    iq_measurements_async, vi_characteristic_async, MeasurementCache, \
+    SweepMetrics, iter_iq_measurements, iter_vi_characteristic, \
+    iter_frequency_response, tee_to_file, checkpointed_iq_measurements, \
+    RunningStatistics, SweepResult, monotonic_violation, MonotonicChecker, \
+    read_metadata
 
 
 class TestDatenAuswetrung(unittest.TestCase):
@@ -55,3 +71,694 @@ class TestDatenAuswetrung(unittest.TestCase):
         vi = np.c_[[-0.6, 0], [0, 3]]
         res = linear_interpolation_y_axis(vi[0], vi[1], 8)
         self.assertEqual(res, 1)
+
+    def test_iq_demodulation(self):
+        n = 1001
+        t = np.arange(n) / 1e4 - (n - 1) / 2 / 1e4
+        c1 = np.cos(2 * np.pi * 100 * t)
+        c2 = 0.5 * np.cos(2 * np.pi * 100 * t - 0.3)
+        h = np.hanning(n)
+        res = iq_demodulation(t, c1, c2, 100)
+        for c, i, q in ((c1, res[0], res[1]), (c2, res[2], res[3])):
+            self.assertAlmostEqual(
+                i, 4 / (n - 1) * np.sum(c * h * np.cos(2 * np.pi * 100 * t)))
+            self.assertAlmostEqual(
+                q, 4 / (n - 1) * np.sum(c * h * np.sin(-2 * np.pi * 100 * t)))
+        self.assertAlmostEqual(res[2], 0.5 * np.cos(0.3), places=3)
+        self.assertAlmostEqual(res[3], -0.5 * np.sin(0.3), places=3)
+
+    def test_iq_measurements_multisine(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        f = np.logspace(3, 6, 7)
+        a, phi = frequency_response(*iq_measurements(source, scope, f, 1.0))
+        a_multi, phi_multi = frequency_response(
+            *iq_measurements_multisine(source, scope, f, 1.0, ncaptures=2))
+        np.testing.assert_allclose(a_multi, a, atol=1e-6)
+        np.testing.assert_allclose(np.angle(np.exp(1j * (phi_multi - phi))),
+                                   0, atol=1e-5)
+        # the source is back in single tone mode at the last frequency
+        np.testing.assert_array_equal(source.frequencies, f[-1:])
+
+    def test_iq_measurements_pipelined(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        f = np.logspace(3, 6, 7)
+        res = iq_measurements_pipelined(source, scope, f, 1.0)
+        test = iq_measurements(source, scope, f, 1.0)
+        for i in range(4):
+            np.testing.assert_array_equal(res[i], test[i])
+
+    def test_iq_measurements_pipelined_overlap(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+
+        class SlowScope:
+            # a scope waiting longer for every capture than the demodulation
+            # takes, so the demodulation can be hidden behind it
+            def waveforms(self):
+                time.sleep(0.05)
+                return scope.waveforms()
+
+        metrics = SweepMetrics()
+        start = time.perf_counter()
+        iq_measurements_pipelined(source, SlowScope(), np.logspace(3, 6, 10),
+                                  1.0, metrics=metrics)
+        total = time.perf_counter() - start
+        summary = metrics.summary()
+        self.assertGreater(summary["acquisition"]["duration"]
+                           + summary["demodulation"]["duration"], total)
+
+    def test_frequency_response_batch(self):
+        i1 = np.ones((2, 3))
+        q1 = np.zeros((2, 3))
+        i2 = np.array([[1, 0, -1], [0.5, 0, -2]])
+        q2 = np.array([[0, -1, 0.001], [0, 0.5, 0.001]])
+        a, phi = frequency_response(i1, q1, i2, q2, unwrap=True)
+        self.assertEqual(a.shape, (2, 3))
+        np.testing.assert_allclose(a[1], [0.5, 0.5, np.hypot(2, 0.001)])
+        np.testing.assert_allclose(
+            phi[0], [0, -np.pi / 2, np.arctan2(0.001, -1) - 2 * np.pi])
+        np.testing.assert_allclose(
+            phi[1], [0, np.pi / 2, np.arctan2(0.001, -2)])
+        a1, phi1 = frequency_response(i1[0], q1[0], i2[0], q2[0])
+        np.testing.assert_allclose(a1, a[0])
+
+    def test_group_delay(self):
+        f = np.logspace(3, 6, 301)
+        tau = 3300 * 1.5e-9
+        phi = -np.arctan(f * 2 * np.pi * tau)
+        test = tau / (1 + (2 * np.pi * f * tau) ** 2)
+        for method in ("gradient", "spline"):
+            res = group_delay(f, np.vstack([phi, 2 * phi]), method=method)
+            np.testing.assert_allclose(res[0], test, rtol=2e-2)
+            np.testing.assert_allclose(res[1], 2 * test, rtol=2e-2)
+
+    def test_group_delay_linear_phase(self):
+        f = np.array([1e3, 2e3, 5e3, 1e4])
+        res = group_delay(f, -2 * np.pi * f * 1e-6)
+        np.testing.assert_allclose(res, 1e-6)
+
+    def test_vi_curve(self):
+        curve = VICurve(np.c_[[8, 1, 2.5], [20, 10, 12]])
+        np.testing.assert_allclose(curve.current([1.4, 1.8, 4]),
+                                   [10.53333333, 11.06666667, 14.18181818])
+        np.testing.assert_allclose(curve.voltage([11.1, 18]), [1.825, 6.625])
+        np.testing.assert_allclose(curve.current([0, 9]),
+                                   [10 - 2 / 1.5, 20 + 8 / 5.5])
+
+    def test_vi_curve_no_extrapolation(self):
+        vi = np.c_[[1, 2.5, 8], [10, 12, 20]]
+        with self.assertRaises(ValueError):
+            interpolation(vi, {"V": [1.4, 9]}, extrapolate=False)
+        res = interpolation(vi, {"I": [10, 20]}, extrapolate=False)
+        np.testing.assert_allclose(res["V"], [1, 8])
+
+    def test_diode_operating_point_cache(self):
+        source = VoltageSource()
+        diode = Diode(source, cache_size=3)
+        solved = []
+        solve = diode._solve
+        diode._solve = lambda v: solved.append(v) or solve(v)
+        res = vi_characteristic(source, VoltMeter(diode), AmpereMeter(diode),
+                                [0.5, 1, 1.5, 2, 0.5])
+        self.assertEqual(solved, [0.5, 1, 1.5, 2, 0.5])
+        self.assertEqual(len(diode._operating_points), 3)
+        vi_characteristic(source, VoltMeter(diode), AmpereMeter(diode),
+                          [1.5, 2])
+        self.assertEqual(len(solved), 5)
+        self.assertAlmostEqual(res[0, 1], (0.5 - res[0, 0]) / 23)
+
+    def test_vi_characteristic_batch(self):
+        source = VoltageSource()
+        diode = Diode(source)
+        source_voltage = np.linspace(-1, 5, 61)
+        res = vi_characteristic(source, VoltMeter(diode), AmpereMeter(diode),
+                                source_voltage, batch=True)
+        test = vi_characteristic(source, VoltMeter(diode),
+                                 AmpereMeter(diode), source_voltage)
+        self.assertEqual(res.shape, (61, 2))
+        np.testing.assert_allclose(res, test, atol=1e-10)
+        self.assertEqual(source.voltage, 5)
+
+        # changing a returned sweep doesn't change the cached one
+        v = VoltMeter(diode).measure_sweep(source_voltage)
+        test = v.copy()
+        v -= 1
+        np.testing.assert_array_equal(
+            VoltMeter(diode).measure_sweep(source_voltage), test)
+
+    def test_save_data(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "save_data.txt")
+            save_data(fname, [1, 2, 3], [[4, 7], [5, 8], [6, 9]],
+                      labels=["a", "b", "c"])
+            with open(fname) as f:
+                self.assertEqual(f.read(), "# a,b,c,\n"
+                                           "1.000000,4.000000,7.000000\n"
+                                           "2.000000,5.000000,8.000000\n"
+                                           "3.000000,6.000000,9.000000\n")
+
+    def test_save_data_append(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "save_data.txt")
+            for i in range(3):
+                save_data(fname, [i], [-i / 3], labels=["i", "x"],
+                          append=True)
+            with open(fname) as f:
+                self.assertEqual(f.read(), "# i,x,\n"
+                                           "0.000000,0.000000\n"
+                                           "1.000000,-0.333333\n"
+                                           "2.000000,-0.666667\n")
+
+    def test_save_data_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "save_data.txt")
+            save_data(fname, [], np.zeros((0, 2)), labels=["a", "b", "c"])
+            with open(fname) as f:
+                self.assertEqual(f.read(), "# a,b,c,\n")
+
+    def test_save_data_metadata(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "save_data.txt")
+            for i in range(2):
+                save_data(fname, [i], labels=["i"], append=True,
+                          metadata={"amplitude": 1.0})
+            with open(fname) as f:
+                self.assertEqual(f.read(), "# i,\n"
+                                           "# metadata: {\"amplitude\": 1.0}\n"
+                                           "0.000000\n"
+                                           "1.000000\n")
+            self.assertEqual(read_metadata(fname), {"amplitude": 1.0})
+            np.testing.assert_array_equal(load_data(fname, True)[0], [[0, 1]])
+            save_data(fname, [0], labels=["i"])
+            self.assertIsNone(read_metadata(fname))
+
+    def test_load_data(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "save_data.txt")
+            save_data(fname, [1, 2, 3], [[4, 7], [5, 8], [6, 9]],
+                      labels=["a", "b", "c"])
+            res, labels = load_data(fname, col_labels=True, chunk_size=2)
+            self.assertEqual(labels, ["a", "b", "c"])
+            self.assertEqual(res.dtype, np.float64)
+            np.testing.assert_array_equal(res, [[1, 2, 3], [4, 5, 6],
+                                                [7, 8, 9]])
+            res = load_data(fname, structured=True)
+            np.testing.assert_array_equal(res["b"], [4, 5, 6])
+
+    def test_load_data_errors(self):
+        with self.assertRaises(ValueError):
+            load_data("dateien/frequency_response_wrong_labels.txt", True)
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "broken.txt")
+            with open(fname, "w") as f:
+                f.write("1.0,2.0\n\n3.0,x\n")
+            with self.assertRaisesRegex(ValueError, "line 3"):
+                load_data(fname)
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "iq_data.t2a")
+            f = np.logspace(3, 6, 31)
+            save_data(fname, f, np.c_[f * 2, f * 3], labels=["f", "a", "b"],
+                      metadata={"amplitude": 1.0})
+            data, header = load_archive(fname)
+            self.assertEqual(header["labels"], ["f", "a", "b"])
+            self.assertEqual(header["metadata"], {"amplitude": 1.0})
+            np.testing.assert_array_equal(data[2], f * 3)
+            res, labels = load_data(fname, col_labels=True)
+            np.testing.assert_array_equal(res, [f, f * 2, f * 3])
+            self.assertEqual(labels, ["f", "a", "b"])
+            with self.assertRaises(ValueError):
+                save_data(fname, f, append=True)
+            del data, res
+
+    def test_adaptive_iq_measurements(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        res = adaptive_iq_measurements(source, scope, np.logspace(3, 6, 4),
+                                       1.0, max_points=200,
+                                       amplitude_tol=0.1, phase_tol=0.1)
+        f = res[0]
+        self.assertTrue(np.all(np.diff(f) > 0))
+        self.assertLess(len(f), 200)
+        a, phi = frequency_response(*res[1:], unwrap=True)
+        self.assertLessEqual(np.max(np.abs(np.diff(phi))), 0.1)
+        self.assertLessEqual(np.max(np.abs(np.diff(np.log(a)))), 0.1)
+        # fewer points below the corner frequency (32 kHz) than above
+        self.assertLess(np.sum(f < 1e4), np.sum((f > 1e4) & (f < 1e5)))
+
+        res = adaptive_iq_measurements(source, scope, np.logspace(3, 6, 4),
+                                       1.0, max_points=10)
+        self.assertEqual(len(res[0]), 10)
+
+    def test_adaptive_vi_characteristic(self):
+        source = VoltageSource()
+        diode = Diode(source)
+        v_meter = VoltMeter(diode)
+        a_meter = AmpereMeter(diode)
+        res = adaptive_vi_characteristic(source, v_meter, a_meter,
+                                         np.linspace(0, 5, 6), tol=1e-4,
+                                         max_points=500)
+        self.assertLess(len(res), 100)
+        self.assertTrue(is_strictly_monotonic(res))
+        test = vi_characteristic(source, v_meter, a_meter,
+                                 np.linspace(0, 5, 2001))
+        error = interpolation(res, {"V": test[:, 0]})["I"] - test[:, 1]
+        self.assertLess(np.max(np.abs(error)), 1e-4)
+
+    def test_acquisition_length(self):
+        self.assertEqual(acquisition_length(1e3, 2.5e6), 25000)
+        self.assertEqual(acquisition_length(1e3, 2.5e6, max_samples=1000),
+                         1000)
+        # 1000 samples are 400 periods at 1 MHz
+        self.assertEqual(acquisition_length(1e6, 2.5e6), 1000)
+        self.assertEqual(acquisition_length(3e5, 2.5e6, periods=100,
+                                            min_samples=10), 833)
+
+    def test_iq_measurements_periods(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        f = np.logspace(3, 6, 7)
+        res = iq_measurements(source, scope, f, 1.0, periods=10)
+        self.assertEqual(scope.nsamples, 100000)
+        test = iq_measurements(source, scope, f, 1.0)
+        for i in range(4):
+            np.testing.assert_allclose(res[i], test[i], atol=1e-5)
+
+    def test_demodulate_captures(self):
+        n = 2001
+        t = np.arange(n) / 1e5 - (n - 1) / 2 / 1e5
+        f = np.linspace(100, 1000, 10)
+        c1 = np.cos(2 * np.pi * f[:, None] * t)
+        c2 = 0.5 * np.sin(2 * np.pi * f[:, None] * t)
+        res = demodulate_captures(t, c1, c2, f, processes=2, chunk_size=3)
+        for i in range(len(f)):
+            test = iq_demodulation(t, c1[i], c2[i], f[i])
+            for j in range(4):
+                self.assertAlmostEqual(res[j][i], test[j])
+        res_local = demodulate_captures(np.tile(t, (len(f), 1)), c1, c2, f,
+                                        processes=1)
+        np.testing.assert_allclose(res_local, res)
+
+    def test_run_stations(self):
+        source = SineSource()
+        register_device(0xA001, source)
+        self.addCleanup(unregister_device, 0xA001)
+        register_device(0xA002, Oscilloscope(source, Filter()))
+        self.addCleanup(unregister_device, 0xA002)
+        stations = {"bench 1": {"source": 0xC34F, "scope": 0xDC31},
+                    "bench 2": {"source": 0xA001, "scope": 0xA002}}
+        f = np.logspace(3, 6, 4)
+        res = run_stations(stations, lambda source, scope: iq_measurements(
+            source, scope, f, 1.0))
+        self.assertEqual(set(res), {"bench 1", "bench 2"})
+        for i in range(4):
+            np.testing.assert_allclose(res["bench 1"][i], res["bench 2"][i])
+        with self.assertRaises(ValueError):
+            run_stations({"bench 3": {"source": 0xA003}}, lambda source: 0)
+
+    def test_run_stations_device_locks(self):
+        register_device(0xA001, SineSource())
+        self.addCleanup(unregister_device, 0xA001)
+        intervals = []
+
+        def sweep(source):
+            # an instrument which needs some time for every sweep
+            start = time.perf_counter()
+            time.sleep(0.1)
+            intervals.append((source, start, time.perf_counter()))
+
+        run_stations({"bench 1": {"source": 0xC34F},
+                      "bench 2": {"source": 0xC34F},
+                      "bench 3": {"source": 0xA001}}, sweep)
+        shared = [(start, end) for source, start, end in intervals
+                  if source is open_device(0xC34F)]
+        other = [(start, end) for source, start, end in intervals
+                 if source is open_device(0xA001)]
+        self.assertEqual(len(shared), 2)
+        # the stations sharing 0xC34F ran one after another
+        (start1, end1), (start2, end2) = sorted(shared)
+        self.assertLessEqual(end1, start2)
+        # the station on 0xA001 ran at the same time as one of them
+        start3, end3 = other[0]
+        self.assertTrue(any(start < end3 and start3 < end
+                            for start, end in shared))
+
+    def test_iq_measurements_async(self):
+        latency = 0.05
+        benches = []
+        for _ in range(2):
+            source = SineSource()
+            scope = Oscilloscope(source, Filter())
+            scope.nsamples = 1000
+            benches.append((AsyncSineSource(source, latency=latency),
+                            AsyncOscilloscope(scope, latency=latency)))
+        f = np.logspace(3, 6, 5)
+
+        async def sweep_all():
+            return await asyncio.gather(*[iq_measurements_async(
+                source, scope, f, 1.0) for source, scope in benches])
+
+        start = time.perf_counter()
+        res = asyncio.run(sweep_all())
+        duration = time.perf_counter() - start
+        # one amplitude, 5 frequency and 5 capture transactions per bench
+        serial = 2 * 11 * latency
+        self.assertLess(duration, 0.75 * serial)
+        source = SineSource()
+        scope = Oscilloscope(source, Filter())
+        scope.nsamples = 1000
+        test = iq_measurements(source, scope, f, 1.0)
+        for i in range(4):
+            np.testing.assert_allclose(res[0][i], test[i])
+            np.testing.assert_allclose(res[1][i], test[i])
+
+    def test_vi_characteristic_async(self):
+        res = asyncio.run(vi_characteristic_async(
+            open_async_device(0x73CC), open_async_device(0x198A),
+            open_async_device(0x4D1E), [0, 1, 2]))
+        test = vi_characteristic(open_device(addr=0x73CC),
+                                 open_device(addr=0x198A),
+                                 open_device(addr=0x4D1E), [0, 1, 2])
+        np.testing.assert_allclose(res, test)
+
+    def test_measurement_cache(self):
+        source = VoltageSource()
+        diode = Diode(source, cache_size=0)
+        measured = []
+        solve = diode._solve
+        diode._solve = lambda v: measured.append(v) or solve(v)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MeasurementCache(directory, fingerprint="diode")
+            res = vi_characteristic(source, VoltMeter(diode),
+                                    AmpereMeter(diode), [0, 1, 2],
+                                    cache=cache)
+            self.assertEqual(len(measured), 6)
+            test = vi_characteristic(source, VoltMeter(diode),
+                                     AmpereMeter(diode), [2, 1, 3, 0],
+                                     cache=cache)
+            self.assertEqual(len(measured), 8)
+            np.testing.assert_array_equal(test[[3, 1, 0]], res)
+
+            cache.invalidate(1.0)
+            self.assertIsNone(cache.get(1.0))
+            self.assertIsNotNone(cache.get(2.0))
+            other = MeasurementCache(directory, fingerprint="other diode")
+            self.assertIsNone(other.get(2.0))
+            cache.invalidate()
+            self.assertIsNone(cache.get(2.0))
+            self.assertEqual(cache.size, 0)
+
+    def test_measurement_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MeasurementCache(directory, fingerprint="bench")
+            cache.put(1.0, [1, 2])
+            size = cache.size
+            cache = MeasurementCache(directory, fingerprint="bench",
+                                     max_bytes=2 * size)
+            self.assertEqual(cache.size, size)
+            cache.put(2.0, [3, 4])
+            cache.get(1.0)
+            cache.put(3.0, [5, 6])
+            self.assertEqual(cache.size, 2 * size)
+            np.testing.assert_array_equal(cache.get(1.0), [1, 2])
+            self.assertIsNone(cache.get(2.0))
+
+            # a new cache continues with the order of use of the files
+            cache = MeasurementCache(directory, fingerprint="bench",
+                                     max_bytes=2 * size)
+            cache.put(4.0, [7, 8])
+            self.assertIsNone(cache.get(3.0))
+            np.testing.assert_array_equal(cache.get(1.0), [1, 2])
+
+    def test_measurement_cache_numpy_settings(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MeasurementCache(directory, fingerprint="bench")
+            cache.put(np.float64(1.0), [1, 2],
+                      {"periods": np.int64(10), "f": np.array([1.0, 2.0])})
+            np.testing.assert_array_equal(
+                cache.get(1.0, {"periods": 10, "f": [1.0, 2.0]}), [1, 2])
+
+    def test_sweep_metrics(self):
+        hooked = []
+        metrics = SweepMetrics(hook=hooked.append)
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        iq_measurements(source, scope, [1e3, 1e4], 1.0, metrics=metrics)
+        summary = metrics.summary()
+        self.assertEqual(summary["acquisition"]["count"], 2)
+        self.assertEqual(summary["demodulation"]["samples"], 200000)
+        self.assertEqual(len(hooked), 6)
+
+        metrics.clear()
+        vi_characteristic(open_device(addr=0x73CC), open_device(addr=0x198A),
+                          open_device(addr=0x4D1E), [0, 1, 2],
+                          metrics=metrics)
+        self.assertEqual(metrics.summary()["measure"]["samples"], 3)
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "save_data.txt")
+            save_data(fname, [1, 2, 3], labels=["a"], metrics=metrics)
+            load_data(fname, True, metrics=metrics)
+        records = metrics.to_records()
+        self.assertEqual(records[-2]["stage"], "write")
+        self.assertEqual(records[-2]["bytes"], 32)
+        self.assertEqual(records[-1]["stage"], "read")
+        self.assertEqual(records[-1]["rows"], 3)
+        self.assertGreaterEqual(records[-1]["duration"], 0)
+
+    def test_sweep_metrics_sweep_variants(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        f = [1e3, 1e4, 1e5]
+        metrics = SweepMetrics()
+        iq_measurements_pipelined(source, scope, f, 1.0, metrics=metrics)
+        summary = metrics.summary()
+        self.assertEqual(summary["settle"]["count"], 3)
+        self.assertEqual(summary["acquisition"]["samples"], 300000)
+        self.assertEqual(summary["demodulation"]["samples"], 300000)
+
+        metrics.clear()
+        iq_measurements_multisine(source, scope, f, 1.0, metrics=metrics)
+        summary = metrics.summary()
+        self.assertEqual(summary["acquisition"]["count"], 1)
+        self.assertEqual(summary["demodulation"]["tones"], 3)
+
+        metrics.clear()
+        asyncio.run(iq_measurements_async(
+            open_async_device(0xC34F), open_async_device(0xDC31), f, 1.0,
+            metrics=metrics))
+        self.assertEqual(metrics.summary()["demodulation"]["count"], 3)
+
+    def test_iter_iq_measurements(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        f = np.logspace(3, 6, 4)
+        test = iq_measurements(source, scope, f, 1.0)
+        a, phi = frequency_response(*test)
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, "iq_data.txt")
+            records = tee_to_file(iter_iq_measurements(source, scope, f, 1.0),
+                                  fname, labels=["f", "I1", "Q1", "I2", "Q2"],
+                                  chunk_size=3)
+            res = list(iter_frequency_response(records))
+            saved = load_data(fname, col_labels=True)[0]
+        np.testing.assert_allclose([r[0] for r in res], f)
+        np.testing.assert_allclose([r[1] for r in res], a)
+        np.testing.assert_allclose([r[2] for r in res], phi)
+        np.testing.assert_allclose(saved[1:], test, atol=1e-6)
+
+    def test_iter_vi_characteristic(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        records = iter_iq_measurements(source, scope, [1e3, 2e3], 1.0)
+        self.assertEqual(next(records)[0], 1e3)
+        self.assertEqual(source.frequency, 1e3)
+        records.close()
+
+        points = iter_vi_characteristic(
+            open_device(addr=0x73CC), open_device(addr=0x198A),
+            open_device(addr=0x4D1E), [1, 2])
+        self.assertEqual(len(next(points)), 2)
+        self.assertEqual(open_device(addr=0x73CC).voltage, 1)
+
+    def test_checkpointed_iq_measurements(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        f = np.logspace(3, 6, 7)
+        test = iq_measurements(source, scope, f, 1.0)
+
+        class FailingScope:
+            sample_rate = scope.sample_rate
+            nsamples = scope.nsamples
+            captures = 0
+
+            def waveforms(self):
+                self.captures += 1
+                if self.captures > 5:
+                    raise RuntimeError("scope disconnected")
+                return scope.waveforms()
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "iq.checkpoint.txt")
+            with self.assertRaises(RuntimeError):
+                checkpointed_iq_measurements(source, FailingScope(), f, 1.0,
+                                             checkpoint, every=2)
+            self.assertEqual(load_data(checkpoint, True)[0].shape, (5, 5))
+
+            resumed = FailingScope()
+            res = checkpointed_iq_measurements(source, resumed, f, 1.0,
+                                               checkpoint, every=2)
+            self.assertEqual(resumed.captures, 2)
+            for i in range(4):
+                np.testing.assert_array_equal(res[i], test[i])
+            self.assertEqual(read_metadata(checkpoint)["amplitude"], 1.0)
+
+            # the points of amplitude 1.0 must not be reused for 2.0
+            other = FailingScope()
+            with self.assertRaises(ValueError):
+                checkpointed_iq_measurements(source, other, f, 2.0,
+                                             checkpoint)
+            self.assertEqual(other.captures, 0)
+
+            fresh = FailingScope()
+            checkpointed_iq_measurements(source, fresh, f[:3], 1.0,
+                                         checkpoint, resume=False)
+            self.assertEqual(fresh.captures, 3)
+
+    def test_running_statistics(self):
+        values = np.random.default_rng(0).normal(size=(20, 3))
+        statistics = RunningStatistics()
+        for row in values:
+            statistics.update(row)
+        self.assertEqual(statistics.count, 20)
+        np.testing.assert_allclose(statistics.mean, values.mean(axis=0))
+        np.testing.assert_allclose(statistics.variance,
+                                   values.var(axis=0, ddof=1))
+        np.testing.assert_allclose(statistics.standard_error,
+                                   values.std(axis=0, ddof=1) / np.sqrt(20))
+
+    def test_iq_measurements_averages(self):
+        source = open_device(addr=0xC34F)
+        scope = Oscilloscope(source, Filter())
+        test = iq_measurements(source, scope, [1e3, 1e5], 1.0)
+        scope.noise = 0.1
+        captures = []
+        scope.waveforms = lambda waveforms=scope.waveforms: \
+            captures.append(1) or waveforms()
+        res = iq_measurements(source, scope, [1e3, 1e5], 1.0, averages=10,
+                              periods=10)
+        self.assertEqual(len(res), 8)
+        self.assertEqual(len(captures), 20)
+        for i in range(4):
+            self.assertTrue(np.all(res[i + 4] > 0))
+            np.testing.assert_allclose(res[i], test[i],
+                                       atol=6 * np.max(res[i + 4]))
+
+        captures.clear()
+        res = iq_measurements(source, scope, [1e3], 1.0, averages=100,
+                              target_stderr=1e-3)
+        self.assertLess(len(captures), 100)
+        self.assertTrue(np.all(np.array(res[4:]) <= 1e-3))
+
+        # the averaged records can be streamed into the frequency response
+        records = iter_iq_measurements(source, scope, [1e3, 1e5], 1.0,
+                                       averages=2)
+        res = list(iter_frequency_response(records))
+        a, phi = frequency_response(*test)
+        np.testing.assert_allclose([r[1] for r in res], a, rtol=0.05)
+
+        with self.assertRaises(ValueError):
+            iq_measurements(source, scope, [1e3], 1.0, averages=0)
+        with self.assertRaises(ValueError):
+            next(iter_iq_measurements(source, scope, [1e3], 1.0, averages=0))
+
+    def test_sweep_result(self):
+        source = open_device(addr=0xC34F)
+        scope = open_device(addr=0xDC31)
+        f = np.logspace(3, 6, 5)
+        test = iq_measurements(source, scope, f, 1.0)
+        res = SweepResult.measure(source, scope, f, 1.0)
+        self.assertEqual(len(res), 5)
+        self.assertTrue(res.data.flags.c_contiguous)
+        np.testing.assert_array_equal(res.f, f)
+        np.testing.assert_array_equal(res["Q2"], test[3])
+        self.assertTrue(np.all(np.isnan(res.a)))
+        data = res.data
+        res.compute_response()
+        self.assertIs(res.data, data)
+        a, phi = frequency_response(*test)
+        np.testing.assert_allclose(res.a, a)
+        np.testing.assert_allclose(res.phi, phi)
+        with self.assertRaises(AttributeError):
+            res.other = 1
+
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("sweep.t2a", "sweep.txt"):
+                fname = os.path.join(directory, name)
+                res.save(fname)
+                loaded = SweepResult.load(fname)
+                np.testing.assert_array_equal(loaded.data, res.data)
+                del loaded
+
+    def test_is_strictly_monotonic_batch(self):
+        vi = np.array([np.c_[[1, 2, 3], [30, 25, 10]],
+                       np.c_[[1, 3, 2], [10, 25, 30]],
+                       np.c_[[3, 2, 1], [30, 30, 10]]])
+        np.testing.assert_array_equal(is_strictly_monotonic(vi),
+                                      [True, False, False])
+        np.testing.assert_array_equal(
+            monotonic_violation([[1, 2, 3, 2], [1, 1, 2, 3], [4, 3, 2, 1]]),
+            [3, 1, -1])
+        self.assertEqual(monotonic_violation([1, 2, 4, 8]), -1)
+
+    def test_monotonic_checker(self):
+        checker = MonotonicChecker()
+        for point in [(1, 10), (2, 12), (3, 15)]:
+            self.assertTrue(checker.add(point))
+        self.assertFalse(checker.add((4, 14)))
+        self.assertFalse(checker.add((5, 20)))
+        self.assertEqual(checker.violation, 3)
+        self.assertFalse(checker.is_monotonic)
+
+    def test_vi_characteristic_check_monotonic(self):
+        class Meter:
+            def __init__(self, values):
+                self.values = iter(values)
+
+            def measure(self):
+                return next(self.values)
+
+        source = VoltageSource()
+        a_meter = Meter([1, 2, 3, 2.5, 4, 5])
+        with self.assertRaisesRegex(ValueError, "index 3"):
+            vi_characteristic(source, Meter([1, 2, 3, 4, 5, 6]), a_meter,
+                              np.arange(6), check_monotonic=True)
+        self.assertEqual(source.voltage, 3)
+        diode = Diode(source)
+        res = vi_characteristic(source, VoltMeter(diode), AmpereMeter(diode),
+                                np.linspace(0, 5, 26), check_monotonic=True,
+                                batch=True)
+        self.assertTrue(is_strictly_monotonic(res))
+
+        # cached and measured points are checked in order, the sweep stops
+        # at the first violation
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MeasurementCache(directory, fingerprint="bad dut")
+            cache.put(0.0, [1, 1])
+            cache.put(1.0, [2, 2])
+            a_meter = Meter([3, 2.5, 4, 5])
+            with self.assertRaisesRegex(ValueError, "index 3"):
+                vi_characteristic(source, Meter([3, 4, 5, 6]), a_meter,
+                                  np.arange(6), cache=cache,
+                                  check_monotonic=True)
+            self.assertEqual(source.voltage, 3)
+            self.assertEqual(list(a_meter.values), [4, 5])
+
+            cache.put(1.0, [1, 2])
+            a_meter = Meter([3])
+            with self.assertRaisesRegex(ValueError, "index 1"):
+                vi_characteristic(source, Meter([3]), a_meter, np.arange(3),
+                                  cache=cache, check_monotonic=True)
+            self.assertEqual(list(a_meter.values), [3])